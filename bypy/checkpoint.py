@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+# Checkpoints allow a failed dependency build to be resumed from the phase
+# that failed instead of from scratch. The build helpers in utils check with
+# should_skip_phase() before running a phase and call phase_completed() after.
+# Phases are numbered in the order they are run, so recipes that run, for
+# example, several configure steps work as expected. Edits to the source tree
+# made by recipes, via replace_in_file() and apply_patch(), are phases as
+# well, so that they are not applied a second time. Phases started while
+# another phase is running are part of it and are always run along with it.
+# Recipe code outside phases is run again when resuming, see run_phase().
+
+import json
+import os
+import shutil
+from collections import Counter
+from collections.abc import Callable
+from contextlib import suppress
+from typing import Any
+
+# Phases that prepare the source tree, see Checkpoint.resumable
+SOURCE_PHASES = ('extract#', 'edit ', 'patch ')
+
+
+class Checkpoint:
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.state_path = os.path.join(path, 'state.json')
+        self.completed: list[str] = []
+        if resume:
+            with suppress(FileNotFoundError, ValueError), open(self.state_path, 'rb') as f:
+                self.completed = json.loads(f.read())['completed']
+        else:
+            with suppress(FileNotFoundError):
+                shutil.rmtree(path)
+        if self.completed and not self.resumable:
+            print('The previous attempt failed before the recipe finished preparing the source, starting from scratch', flush=True)
+            self.completed = []
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+        self.seen: Counter[str] = Counter()
+        # The phases being run, innermost last, nested phases are empty
+        self.running: list[str] = []
+
+    @property
+    def resumable(self) -> bool:
+        ''' Recipes can modify the source tree in ways that are not recorded
+        as phases before configuring it, so a build can only be resumed once a
+        phase after that has completed '''
+        return any(not x.startswith(SOURCE_PHASES) for x in self.completed)
+
+    def dir_for(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def should_skip(self, phase: str) -> bool:
+        if self.running:
+            self.running.append('')
+            return False
+        self.seen[phase] += 1
+        current_phase = f'{phase}#{self.seen[phase]}'
+        if current_phase in self.completed:
+            print(f'Skipping {phase}, it was completed by a previous attempt', flush=True)
+            return True
+        self.running.append(current_phase)
+        return False
+
+    def phase_completed(self) -> None:
+        current_phase = self.running.pop() if self.running else ''
+        if current_phase and current_phase not in self.completed:
+            from .utils import atomic_write
+            self.completed.append(current_phase)
+            atomic_write(self.state_path, json.dumps({'completed': self.completed}, indent=2))
+
+    def remove(self) -> None:
+        with suppress(FileNotFoundError):
+            shutil.rmtree(self.path)
+
+
+def current_checkpoint(val: Checkpoint | None | bool = False) -> Checkpoint | None:
+    if val is not False:
+        setattr(current_checkpoint, 'ans', val)
+    return getattr(current_checkpoint, 'ans', None)
+
+
+def should_skip_phase(phase: str) -> bool:
+    ''' Must be called before running a phase (extract, edit, patch,
+    configure, build, install or package) of a build. Returns True if the
+    build is being resumed and a previous attempt completed this phase. '''
+    c = current_checkpoint()
+    return c is not None and c.should_skip(phase)
+
+
+def phase_completed() -> None:
+    ' Record that the phase last passed to should_skip_phase() has completed '
+    if (c := current_checkpoint()) is not None:
+        c.phase_completed()
+
+
+def run_phase(phase: str, func: Callable[[], Any]) -> None:
+    ''' Run func() as a phase of the build. Recipe code that is not part of a
+    phase is run again when resuming a build, so steps that cannot be
+    repeated, such as moving installed files, must be run as phases. '''
+    if not should_skip_phase(phase):
+        func()
+        phase_completed()
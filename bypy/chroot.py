@@ -201,7 +201,7 @@ class Chroot:
         yield p(
             'apt-get install -y build-essential software-properties-common'
             ' nasm chrpath zsh git uuid-dev libmount-dev apt-transport-https patchelf'
-            ' dh-autoreconf gperf strace sudo vim screen zsh-syntax-highlighting'
+            ' dh-autoreconf gperf strace sudo vim screen zsh-syntax-highlighting ccache'
         )
         for cmd in install_kitten(self.image_arch):
             yield p(cmd)
@@ -412,7 +412,11 @@ date >> /root/fix-mounting-ran-at
     def run_func(self, sources_dir: str, pkg_dir: str, output_dir: str, func, *args, **kwargs):
         from .chroot_linux import chroot
         bypy_src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        with chroot(self.vm_path, {bypy_src: '/sw/bypy', sources_dir: '/sw/sources', pkg_dir: '/sw/pkg', output_dir: '/sw/dist'}):
+        ccache_dir = os.path.join(self.output_dir, 'ccache')
+        os.makedirs(ccache_dir, exist_ok=True)
+        with chroot(self.vm_path, {
+            bypy_src: '/sw/bypy', sources_dir: '/sw/sources', pkg_dir: '/sw/pkg', output_dir: '/sw/dist', ccache_dir: '/sw/ccache',
+        }):
             os.chdir(os.path.expanduser('~'))
             func(*args, **kwargs)
 
@@ -30,6 +30,7 @@ import time
 import traceback
 import zipfile
 import zlib
+from collections.abc import Sequence
 from contextlib import contextmanager, suppress
 from enum import IntFlag, auto
 from importlib import resources
@@ -83,6 +84,39 @@ def mount(source, target, fs='', flags: MountOption = MountOption(0), options: s
         raise OSError(n, args, source, None, target)
 
 
+def make_mounts_private(mountpoint: str = '/') -> None:
+    # Stop mounts made in this mount namespace from propagating to its parent
+    flags = MountOption.MS_REC | MountOption.MS_PRIVATE
+    ret = ctypes.CDLL(None, use_errno=True).mount(None, mountpoint.encode(), None, ctypes.c_ulong(int(flags)), None)
+    if ret < 0:
+        n = ctypes.get_errno()
+        raise OSError(n, f'{os.strerror(n)}: {mountpoint=} {flags=}', mountpoint)
+
+
+def mount_overlay(lower_dirs: Sequence[str], target: str, scratch: str) -> None:
+    '''
+    Mount an overlay at target with the specified read-only lower dirs, the
+    first one being the topmost, and a writable upper layer in a tmpfs
+    mounted at scratch. Works inside user namespaces since Linux 5.11.
+    '''
+    mount('tmpfs', scratch, 'tmpfs', MountOption.MS_NOSUID | MountOption.MS_NODEV, 'mode=0755')
+    upper, work = os.path.join(scratch, 'upper'), os.path.join(scratch, 'work')
+    os.mkdir(upper), os.mkdir(work)
+    if not lower_dirs:
+        os.mkdir(os.path.join(scratch, 'empty'))
+        lower_dirs = [os.path.join(scratch, 'empty')]
+    # The mount options are limited to a page in size, so use lower dirs
+    # relative to their common parent
+    base = os.path.commonpath([os.path.dirname(os.path.abspath(x)) for x in lower_dirs])
+    cwd = os.getcwd()
+    os.chdir(base)
+    try:
+        lower = ':'.join(os.path.relpath(x, base) for x in lower_dirs)
+        mount('overlay', target, 'overlay', MountOption(0), f'lowerdir={lower},upperdir={upper},workdir={work},userxattr')
+    finally:
+        os.chdir(cwd)
+
+
 def umount(mountpoint: str, lazy: bool = False) -> None:
     flags = UnmountOption.UMOUNT_NOFOLLOW
     if lazy:
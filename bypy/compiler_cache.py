@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+# Support for caching the output of the compiler across builds, using ccache
+
+import os
+import shutil
+from functools import lru_cache
+
+from .constants import CCACHE_DIR, iswindows, temp_root, worker_env
+
+CMAKE_LAUNCHER_VARS = tuple(f'CMAKE_{lang}_COMPILER_LAUNCHER' for lang in ('C', 'CXX', 'OBJC', 'OBJCXX'))
+# These only affect where and how compiler output is cached, not what is built
+COMPILER_CACHE_ENV = frozenset({
+    'CCACHE_DIR', 'CCACHE_BASEDIR', 'CCACHE_NOHASHDIR', 'CCACHE_STATSLOG', 'CCACHE_SLOPPINESS'}) | frozenset(CMAKE_LAUNCHER_VARS)
+HIT_COUNTERS = frozenset({'direct_cache_hit', 'preprocessed_cache_hit'})
+MISS_COUNTERS = frozenset({'cache_miss'})
+
+
+@lru_cache(maxsize=2)
+def ccache() -> str:
+    # ccache support for MSVC via nmake is too limited to be useful
+    return '' if iswindows else (shutil.which('ccache') or '')
+
+
+def compiler_cache_enabled() -> bool:
+    return 'CCACHE_DIR' in worker_env
+
+
+def setup_compiler_cache() -> bool:
+    '''
+    Make the build tools run the compiler via ccache. CMake picks it up via the
+    CMAKE_<LANG>_COMPILER_LAUNCHER environment variables, meson detects ccache
+    on its own and simple_build() sets CC and CXX for configure scripts.
+    '''
+    exe = ccache()
+    if not exe:
+        return False
+    os.makedirs(CCACHE_DIR, exist_ok=True)
+    worker_env.update({
+        'CCACHE_DIR': CCACHE_DIR,
+        # Dependencies are built in randomly named temporary directories,
+        # rewrite paths to be relative to them so that they dont cause misses
+        'CCACHE_BASEDIR': temp_root(),
+        'CCACHE_NOHASHDIR': '1',
+        'CCACHE_SLOPPINESS': 'include_file_ctime,include_file_mtime,time_macros',
+    })
+    for x in CMAKE_LAUNCHER_VARS:
+        worker_env[x] = exe
+    return True
+
+
+def compiler_cache_env(env: dict[str, str]) -> dict[str, str]:
+    ' Set CC and CXX to use the compiler cache, unless they are already set '
+    if compiler_cache_enabled():
+        for var, compiler in (('CC', 'cc'), ('CXX', 'c++')):
+            if var not in env and var not in os.environ:
+                env[var] = f'{ccache()} {compiler}'
+    return env
+
+
+def start_compiler_cache_stats(log_path: str) -> None:
+    ' Record the result of every compilation in log_path '
+    if compiler_cache_enabled():
+        with open(log_path, 'w'):
+            pass
+        worker_env['CCACHE_STATSLOG'] = log_path
+
+
+def compiler_cache_stats(log_path: str) -> tuple[int, int]:
+    ' The number of hits and misses recorded in log_path '
+    hits = misses = 0
+    try:
+        with open(log_path) as f:
+            for line in f:
+                line = line.strip()
+                if line in HIT_COUNTERS:
+                    hits += 1
+                elif line in MISS_COUNTERS:
+                    misses += 1
+    except FileNotFoundError:
+        pass
+    return hits, misses
+
+
+def report_compiler_cache_stats(name: str, log_path: str) -> None:
+    if not compiler_cache_enabled():
+        return
+    worker_env.pop('CCACHE_STATSLOG', None)
+    hits, misses = compiler_cache_stats(log_path)
+    if total := hits + misses:
+        print(f'Compiler cache for {name}: {hits} hits and {misses} misses, hit rate: {100 * hits / total:.0f}%', flush=True)
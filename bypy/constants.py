@@ -51,6 +51,8 @@ if iswindows:
 OUTPUT_DIR = os.path.join(SW, 'dist')
 WORKER_DIR = os.path.join(SW, 'worker')
 PKG = os.path.join(SW, 'pkg')
+CCACHE_DIR = os.path.join(SW, 'ccache')
+SOURCE_TREES_DIR = os.path.join(SW, 'source-trees')
 BYPY = os.path.join(ROOT, 'bypy')
 SRC = os.path.join(ROOT, 'src')
 OS_NAME = 'windows' if iswindows else ('macos' if ismacos else 'linux')
@@ -158,7 +160,9 @@ else:
             f'-L{LIBDIR} -Wl,-rpath-link,{LIBDIR}'
 
 
-def mkdtemp(prefix=''):
+def temp_root():
+    # The root is cleared on first use, so it must be initialized before
+    # forking worker processes that create temporary dirs concurrently
     tdir = getattr(mkdtemp, 'tdir', None)
     if tdir is None:
         if ismacos:
@@ -170,7 +174,11 @@ def mkdtemp(prefix=''):
         from .utils import ensure_clear_dir
         ensure_clear_dir(tdir)
         mkdtemp.tdir = tdir
-    return tempfile.mkdtemp(prefix=prefix, dir=tdir)
+    return tdir
+
+
+def mkdtemp(prefix=''):
+    return tempfile.mkdtemp(prefix=prefix, dir=temp_root())
 
 
 def current_build_arch(val=False):
@@ -191,6 +199,33 @@ def qt_webengine_is_used(val: bool | None = None) -> bool:
     return getattr(qt_webengine_is_used, 'ans', False)
 
 
+def build_parallelism(val: int | None = None) -> int:
+    ''' The number of parallel jobs a single dependency build is limited to, 0 if unlimited '''
+    if val is not None:
+        setattr(build_parallelism, 'ans', val)
+    return getattr(build_parallelism, 'ans', 0)
+
+
+def used_parallelism(val: int = 0, reset: bool = False) -> int:
+    ''' The most parallel jobs the build of the current dependency has run,
+    as recorded by the build helpers. Builds that record nothing ran serially. '''
+    if reset:
+        setattr(used_parallelism, 'ans', 0)
+    if val:
+        setattr(used_parallelism, 'ans', max(val, getattr(used_parallelism, 'ans', 0)))
+    return getattr(used_parallelism, 'ans', 0)
+
+
+def makeopts() -> str:
+    if n := build_parallelism():
+        used_parallelism(n)
+        return f'-j{n}'
+    # When bypy is running a jobserver, it controls the parallelism of make
+    # limiting it to at most cpu_count() jobs
+    used_parallelism(cpu_count() or 1)
+    return '' if '--jobserver-auth=' in os.environ.get('MAKEFLAGS', '') else f'-j{cpu_count()}'
+
+
 def build_dir(newval=None, current_arch=None):
     if newval is not None:
         build_dir.ans = newval
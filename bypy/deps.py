@@ -2,29 +2,68 @@
 # vim:fileencoding=utf-8
 # License: GPLv3 Copyright: 2019, Kovid Goyal <kovid at kovidgoyal.net>
 
+import hashlib
 import importlib
+import json
 import os
+import re
 import sys
-from collections.abc import Sequence
+from collections.abc import Iterable, Sequence
+from contextlib import contextmanager, suppress
 from typing import Any
 
-from .constants import PKG, PREFIX, SOURCES, UNIVERSAL_ARCHES, build_dir, current_build_arch, currently_building_dep, ismacos, lipo_data, mkdtemp, qt_webengine_is_used
-from .download_sources import Dependency, ensure_downloaded, read_deps
+from .checkpoint import Checkpoint, current_checkpoint, phase_completed, should_skip_phase
+from .compiler_cache import (
+    COMPILER_CACHE_ENV,
+    report_compiler_cache_stats,
+    setup_compiler_cache,
+    start_compiler_cache_stats,
+)
+from .constants import (
+    CCACHE_DIR,
+    OS_NAME,
+    PATCHES,
+    PKG,
+    PREFIX,
+    SOURCES,
+    SW,
+    UNIVERSAL_ARCHES,
+    WORKER_DIR,
+    build_dir,
+    cpu_count,
+    current_build_arch,
+    currently_building_dep,
+    in_chroot,
+    is64bit,
+    islinux,
+    ismacos,
+    lipo_data,
+    mkdtemp,
+    qt_webengine_is_used,
+    worker_env,
+)
+from .download_sources import Dependency, ensure_downloaded, mirror_url, read_deps
+from .jobserver import jobserver
+from .scheduler import BuildHistory, Scheduler
 from .utils import (
     RunFailure,
+    atomic_write,
     create_package,
+    dedup_packages,
     ensure_clear_dir,
     extract_source_and_chdir,
     fix_install_names,
     install_package,
+    lcopy,
     lipo,
+    package_contents,
     python_build,
     python_install,
     qt_build,
     rmtree,
     run_shell,
-    set_title,
     simple_build,
+    verify_package,
 )
 
 
@@ -50,6 +89,226 @@ def module_for_dep(dep: Dependency):
     return m
 
 
+def declared_inputs(dep: Dependency) -> tuple[str, ...] | None:
+    ''' The names of the dependencies dep needs to build, as declared in its
+    sources.json entry and/or by a depends attribute in its recipe module.
+    None if there is no declaration. '''
+    declared = getattr(module_for_dep(dep), 'depends', None)
+    if declared is None and dep.declared_depends is None:
+        return None
+    return tuple(declared or ()) + tuple(dep.declared_depends or ())
+
+
+def dependency_graph(all_deps: Sequence[Dependency]) -> dict[str, tuple[str, ...]]:
+    ''' Map the name of every dependency to the names of the dependencies that
+    must be installed in PREFIX to build it. Dependencies without a
+    declaration depend on everything before them in sources.json '''
+    names = tuple(d.name for d in all_deps)
+    qt_names = tuple(x for x in names if x.startswith('qt-'))
+    ans: dict[str, tuple[str, ...]] = {}
+    for i, dep in enumerate(all_deps):
+        declared = declared_inputs(dep)
+        if declared is None:
+            ans[dep.name] = names[:i]
+            continue
+        q: list[str] = []
+        for x in declared:
+            q.extend(qt_names if x == 'qt' else (x,))
+        ans[dep.name] = tuple(x for x in names if x in q and x != dep.name)
+    return ans
+
+
+def transitive_inputs(graph: dict[str, tuple[str, ...]]) -> dict[str, frozenset[str]]:
+    ans: dict[str, frozenset[str]] = {}
+
+    def get(name: str, seen: frozenset[str] = frozenset()) -> frozenset[str]:
+        if (q := ans.get(name)) is None:
+            if name in seen:
+                raise SystemExit(f'The dependency {name} transitively depends on itself')
+            seen |= {name}
+            q = ans[name] = frozenset(graph.get(name, ())).union(*(get(x, seen) for x in graph.get(name, ())))
+        return q
+    for name in graph:
+        get(name)
+    return ans
+
+
+# Variables in worker_env that do not affect the output of a build
+BUILD_KEY_IGNORED_ENV = frozenset({'NUMBER_OF_PROCESSORS'}) | COMPILER_CACHE_ENV
+
+
+def sha256_of(*parts: str | bytes) -> str:
+    h = hashlib.sha256()
+    for x in parts:
+        h.update(x.encode('utf-8') if isinstance(x, str) else x)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def recipe_source(dep: Dependency) -> str:
+    m = module_for_dep(dep)
+    if m is None and dep.name.startswith('qt-'):
+        m = importlib.import_module('bypy.pkgs.qt_base')
+    if m is None:
+        return ''
+    with open(m.__file__, 'rb') as f:
+        return f.read().decode('utf-8')
+
+
+def patches_used_by(dep: Dependency, src: str) -> list[str]:
+    ''' Patches named after dep, passed to apply_patch() or read from PATCHES
+    in its recipe, or matched by a prefix passed to apply_patches() '''
+    try:
+        patches = os.listdir(PATCHES)
+    except FileNotFoundError:
+        return []
+    names = set(re.findall(r'''(?:\bapply_patch\(\s*|\bos\.path\.join\(\s*PATCHES,\s*)['"]([^'"]+)['"]''', src))
+    prefixes = tuple(re.findall(r'''\bapply_patches\(\s*['"]([^'"]+)['"]''', src))
+    return sorted(x for x in patches if x.startswith(dep.name + '-') or x in names or (
+        x.endswith('.patch') and x.startswith(prefixes)))
+
+
+def patches_hash(dep: Dependency, src: str) -> str:
+    patches = []
+    for x in patches_used_by(dep, src):
+        with open(os.path.join(PATCHES, x), 'rb') as f:
+            patches += [x, f.read()]
+    return sha256_of(*patches)
+
+
+def build_environment() -> str:
+    env = {k: v for k, v in worker_env.items() if k not in BUILD_KEY_IGNORED_ENV}
+    return sha256_of(json.dumps({
+        'os': OS_NAME, 'is64bit': is64bit, 'arches': sorted(UNIVERSAL_ARCHES), 'env': env}, sort_keys=True))
+
+
+def compute_build_keys(all_deps: Sequence[Dependency], graph: dict[str, tuple[str, ...]]) -> dict[str, dict[str, Any]]:
+    ''' The key of a dependency changes whenever its source, recipe, patches,
+    build environment or the key of any of its inputs change. '''
+    deps = {d.name: d for d in all_deps}
+    env = build_environment()
+    ans: dict[str, dict[str, Any]] = {}
+
+    def get(name: str) -> str:
+        if (q := ans.get(name)) is None:
+            dep = deps[name]
+            src = recipe_source(dep)
+            components = {
+                # For pypi deps expected_hash is only known after querying pypi
+                'source': sha256_of(dep.name, dep.version, '' if dep.ecosystem else dep.expected_hash),
+                'recipe': sha256_of(src),
+                'patches': patches_hash(dep, src),
+                'environment': env,
+                'inputs': {x: get(x) for x in graph[name]},
+            }
+            q = ans[name] = {'key': sha256_of(json.dumps(components, sort_keys=True)), 'components': components}
+        return q['key']
+    for name in deps:
+        get(name)
+    return ans
+
+
+def build_key_path(dep: Dependency) -> str:
+    return pkg_path(dep) + '.key'
+
+
+def write_build_key(dep: Dependency, build_key: dict[str, Any]) -> None:
+    atomic_write(build_key_path(dep), json.dumps(build_key, indent=2, sort_keys=True))
+
+
+def cache_miss_reason(dep: Dependency, build_key: dict[str, Any]) -> str:
+    ''' Why dep needs to be built, or the empty string if its package is up to date '''
+    if not os.path.exists(pkg_path(dep)):
+        return 'not built'
+    try:
+        with open(build_key_path(dep), 'rb') as f:
+            stored = json.loads(f.read())
+    except FileNotFoundError:
+        # Built before keys were recorded, adopt the package as is
+        print(f'{dep.name}: no build key recorded, assuming it is up to date')
+        write_build_key(dep, build_key)
+        return ''
+    if stored.get('key') == build_key['key']:
+        return ''
+    old, new = stored.get('components', {}), build_key['components']
+    changed = [k for k in ('source', 'recipe', 'patches', 'environment') if old.get(k) != new[k]]
+    old_inputs, new_inputs = old.get('inputs', {}), new['inputs']
+    if inputs := [x for x in new_inputs if old_inputs.get(x) != new_inputs[x]]:
+        changed.append('inputs (' + ', '.join(inputs[:5]) + (', ...' if len(inputs) > 5 else '') + ')')
+    if removed := sorted(set(old_inputs) - set(new_inputs)):
+        changed.append('removed inputs (' + ', '.join(removed[:5]) + (', ...' if len(removed) > 5 else '') + ')')
+    return ' and '.join(changed or ['key']) + ' changed'
+
+
+def can_isolate_builds() -> bool:
+    # Private mounts over PREFIX need the mount namespace privileges we have
+    # as root inside the rootless Linux container
+    return islinux and in_chroot() and os.geteuid() == 0
+
+
+def mount_packages(which_deps: Sequence[Dependency], dest_dir: str = PREFIX) -> str:
+    '''
+    Mount the specified packages as the read-only lower layers of an overlay
+    at dest_dir, so that no files need to be copied. Returns the directory
+    holding the upper layer or an empty string if overlays are not supported,
+    in which case nothing is mounted.
+    '''
+    from .chroot_linux import mount_overlay, umount
+    # Later packages overwrite the files of earlier ones and in an overlay
+    # the first lower layer is the topmost
+    lower_dirs = [pkg_path(dep) for dep in reversed(which_deps) if os.path.exists(pkg_path(dep))]
+    os.makedirs(dest_dir, exist_ok=True)
+    scratch = mkdtemp('overlay-')
+    try:
+        mount_overlay(lower_dirs, dest_dir, scratch)
+    except OSError as err:
+        with suppress(OSError):
+            umount(scratch, lazy=True)
+        rmtree(scratch)
+        print('Mounting packages as an overlay failed, installing them instead. Error:', err, file=sys.stderr)
+        return ''
+    return scratch
+
+
+def unmount_packages(scratch: str, dest_dir: str = PREFIX) -> None:
+    from .chroot_linux import umount
+    umount(dest_dir, lazy=True)
+    umount(scratch, lazy=True)
+    rmtree(scratch)
+
+
+def use_private_prefix(inputs: Sequence[Dependency], overlay: bool = False) -> str:
+    ''' Mount a view of PREFIX containing only the specified packages over
+    PREFIX, visible only to this process and its children. Returns the
+    directory holding the view, which must be passed to
+    release_private_prefix() when done. '''
+    from .chroot_linux import make_mounts_private, mount
+    os.unshare(os.CLONE_NEWNS)
+    make_mounts_private()
+    os.makedirs(PREFIX, exist_ok=True)
+    if overlay and (scratch := mount_packages(inputs, PREFIX)):
+        return scratch
+    view = mkdtemp(prefix='prefix-')
+    install_packages(inputs, view, verbose=False)
+    mount(view, PREFIX)
+    return view
+
+
+def release_private_prefix(view: str) -> None:
+    if os.path.ismount(view):
+        # The upper layer of an overlay, see mount_packages()
+        unmount_packages(view)
+    else:
+        rmtree(view)
+        forget_installed_state(view)
+
+
+def is_interactive(args) -> bool:
+    # Concurrent builds have no terminal to share, so failures are reported
+    # via their logs instead of a shell
+    return getattr(args, 'jobs', 1) < 2
+
+
 class CleanupDirs:
 
     def __init__(self):
@@ -73,10 +332,26 @@ def build_once(dep: Dependency, m, args, cleanup, target=None):
     base = dep.name
     if target:
         base += f'.{target}.'
-    output_dir = make_build_dir(base)
-    build_dir(output_dir, target)
-    cleanup(output_dir)
-    cleanup(extract_source_and_chdir(os.path.join(SOURCES, dep.filename)))
+    source = os.path.join(SOURCES, dep.filename)
+    # Globs for parts of the source, such as tests, that the build does not use
+    exclude = getattr(m, 'extract_exclude', ())
+    patches = patches_hash(dep, recipe_source(dep))
+    if (checkpoint := current_checkpoint()) is None:
+        output_dir = make_build_dir(base)
+        build_dir(output_dir, target)
+        cleanup(output_dir)
+        cleanup(extract_source_and_chdir(source, source_hash=dep.expected_hash, exclude=exclude, patches=patches))
+    else:
+        # Absolute paths to the build tree end up in the files generated by
+        # configure, so it has to be at the same location when resuming
+        output_dir, src_dir = checkpoint.dir_for(f'{base}-output'), checkpoint.dir_for(f'{base}-src')
+        build_dir(output_dir, target)
+        if should_skip_phase('extract'):
+            os.chdir(src_dir)
+        else:
+            ensure_clear_dir(output_dir)
+            extract_source_and_chdir(source, src_dir, dep.expected_hash, exclude, patches)
+            phase_completed()
     try:
         if hasattr(m, 'main'):
             m.main(args)
@@ -93,21 +368,47 @@ def build_once(dep: Dependency, m, args, cleanup, target=None):
     except RunFailure as e:
         print('\nRunning the following command failed:', file=sys.stderr)
         print(e.cmd)
-        print('Dropping you into a shell', file=sys.stderr)
-        sys.stdout.flush(), sys.stderr.flush()
-        run_shell(env=e.env, cwd=e.cwd)
+        if is_interactive(args):
+            print('Dropping you into a shell', file=sys.stderr)
+            sys.stdout.flush(), sys.stderr.flush()
+            run_shell(env=e.env, cwd=e.cwd)
         raise SystemExit(1)
     except (Exception, SystemExit):
         import traceback
         traceback.print_exc()
-        print('\nDropping you into a shell')
-        sys.stdout.flush(), sys.stderr.flush()
-        run_shell(cwd=build_dir())
+        if is_interactive(args):
+            print('\nDropping you into a shell')
+            sys.stdout.flush(), sys.stderr.flush()
+            run_shell(cwd=build_dir())
         raise SystemExit(1)
     return output_dir
 
 
-def build_dep(dep: Dependency, args, dest_dir: str = PREFIX):
+@contextmanager
+def checkpoints_for(dep: Dependency, args):
+    ''' When requested, keep the build tree and record the phases of the build
+    that complete, so that it can be resumed if it fails '''
+    resume = getattr(args, 'resume', '') == dep.name
+    if not resume and not getattr(args, 'checkpoint', False):
+        yield
+        return
+    checkpoint = Checkpoint(os.path.join(WORKER_DIR, 'checkpoints', dep.name), resume=resume)
+    current_checkpoint(checkpoint)
+    try:
+        yield
+    except BaseException:
+        if checkpoint.resumable:
+            print(f'\nThe build tree of {dep.name} has been kept, resume the build with: bypy deps --resume {dep.name}', file=sys.stderr)
+        else:
+            print(f'\nThe build of {dep.name} failed while preparing the source, it has to be restarted from scratch', file=sys.stderr)
+        raise
+    else:
+        checkpoint.remove()
+    finally:
+        current_checkpoint(None)
+
+
+def build_dep(dep: Dependency, args, dest_dir: str = PREFIX, build_key: dict[str, Any] | None = None):
     current_build_arch(None)
     currently_building_dep(dep)
     dep_name = dep.name
@@ -115,7 +416,11 @@ def build_dep(dep: Dependency, args, dest_dir: str = PREFIX):
     m = module_for_dep(dep)
     needs_lipo = ismacos and getattr(
         m, 'needs_lipo', False) and len(UNIVERSAL_ARCHES) > 1
-    with CleanupDirs() as cleanup:
+    with checkpoints_for(dep, args), CleanupDirs() as cleanup:
+        stats_dir = mkdtemp('ccache-stats-')
+        cleanup(stats_dir)
+        stats_log = os.path.join(stats_dir, 'stats.log')
+        start_compiler_cache_stats(stats_log)
         if needs_lipo:
             output_dirs = []
             lipo_data.clear()
@@ -126,10 +431,17 @@ def build_dep(dep: Dependency, args, dest_dir: str = PREFIX):
             getattr(m, 'lipo', lipo)(output_dirs)
         else:
             build_once(dep, m, args, cleanup)
+        report_compiler_cache_stats(dep_name, stats_log)
 
         if m is None and dep_name.startswith('qt-'):
             m = importlib.import_module('bypy.pkgs.qt_base')
-        create_package(m, pkg_path(dep))
+        if not should_skip_phase('package'):
+            # The package is up to date only once it passes post_install_check()
+            with suppress(FileNotFoundError):
+                os.remove(build_key_path(dep))
+            create_package(m, pkg_path(dep))
+            phase_completed()
+        forget_installed_state(dest_dir)
         install_package(pkg_path(dep), dest_dir)
         if hasattr(m, 'post_install_check'):
             try:
@@ -137,37 +449,153 @@ def build_dep(dep: Dependency, args, dest_dir: str = PREFIX):
             except (Exception, SystemExit):
                 import traceback
                 traceback.print_exc()
-                print('\nDropping you into a shell')
-                sys.stdout.flush(), sys.stderr.flush()
-                run_shell()
+                if is_interactive(args):
+                    print('\nDropping you into a shell')
+                    sys.stdout.flush(), sys.stderr.flush()
+                    run_shell()
                 raise SystemExit(1)
+        if build_key is not None:
+            write_build_key(dep, build_key)
     os.chdir(owd)
 
 
-def unbuilt(dep):
-    return not os.path.exists(pkg_path(dep))
+# Records which files of which packages are installed in a directory. It is
+# kept outside the directory so that it is not part of the tree it describes.
+INSTALLED_STATE_DIR = os.path.join(SW, 'installed-state')
 
 
-def install_packages(which_deps: Sequence[Dependency], dest_dir: str = PREFIX) -> None:
-    ensure_clear_dir(dest_dir)
-    paths = {dep.name: pkg_path(dep) for dep in which_deps if os.path.exists(pkg_path(dep))}
-    if not paths:
-        return
-    print(f'Installing {len(paths)} previously compiled packages:',
-          end=' ')
-    sys.stdout.flush()
-    for dep in which_deps:
-        if pkg := paths.get(dep.name):
-            print(dep.name, end=', ', flush=True)
-            install_package(pkg, dest_dir)
-    print()
-    sys.stdout.flush()
+def package_identity(path: str) -> str:
+    # Packages are re-created when rebuilt and their build key is re-written
+    st = os.stat(path)
+    try:
+        with open(path + '.key', 'rb') as f:
+            key = f.read()
+    except FileNotFoundError:
+        key = b''
+    return sha256_of(str(st.st_ino), str(st.st_mtime_ns), key)
+
+
+def installed_state_path(dest_dir: str) -> str:
+    return os.path.join(INSTALLED_STATE_DIR, sha256_of(os.path.abspath(dest_dir))[:32] + '.json')
 
 
-def init_env(which_deps: None | Sequence[Dependency] = None):
+def read_installed_state(dest_dir: str) -> dict[str, Any] | None:
+    try:
+        with open(installed_state_path(dest_dir), 'rb') as f:
+            return json.loads(f.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def forget_installed_state(dest_dir: str) -> None:
+    ' Must be called before modifying dest_dir other than via install_packages() '
+    with suppress(FileNotFoundError):
+        os.remove(installed_state_path(dest_dir))
+
+
+def file_owners(packages: dict[str, dict[str, Any]], order: Iterable[str]) -> dict[str, str]:
+    ' Map files to the package they are installed from, later packages overwrite the files of earlier ones '
+    ans = {}
+    for name in order:
+        for x in packages[name]['files']:
+            ans[x] = name
+    return ans
+
+
+def installed_file_signature(path: str) -> list[int]:
+    # Modifying an installed file, or replacing it, changes its signature
+    st = os.lstat(path)
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def install_packages(which_deps: Sequence[Dependency], dest_dir: str = PREFIX, verbose: bool = True) -> None:
+    '''
+    Make dest_dir contain exactly the files of the specified packages. If
+    there is a record of a previous installation into dest_dir, only the files
+    of packages that changed since then, and files in dest_dir that are not as
+    they were installed, are added, removed or replaced, otherwise it is
+    cleared and everything is installed.
+    '''
+    installed = read_installed_state(dest_dir)
+    if installed is None or not os.path.isdir(dest_dir):
+        ensure_clear_dir(dest_dir)
+        installed = {'packages': {}, 'order': [], 'files': {}}
+    forget_installed_state(dest_dir)
+    old_packages: dict[str, dict[str, Any]] = installed['packages']
+    packages: dict[str, dict[str, Any]] = {}
+    changed = []
+    for dep in which_deps:
+        pkg = pkg_path(dep)
+        try:
+            identity = package_identity(pkg)
+        except FileNotFoundError:
+            continue
+        if (q := old_packages.get(dep.name)) is not None and q['identity'] == identity:
+            packages[dep.name] = q
+        else:
+            dirs, files = package_contents(pkg)
+            packages[dep.name] = {'identity': identity, 'dirs': dirs, 'files': files}
+            changed.append(dep.name)
+    order = [dep.name for dep in which_deps if dep.name in packages]
+    old_owners = file_owners(old_packages, installed['order'])
+    owners = file_owners(packages, order)
+    removed = frozenset(old_packages) - frozenset(packages)
+    if verbose and (changed or removed):
+        if changed:
+            print(f'Installing {len(changed)} of {len(order)} previously compiled packages:', ', '.join(changed))
+        if removed:
+            print(f'Uninstalling {len(removed)} packages:', ', '.join(sorted(removed)))
+        sys.stdout.flush()
+
+    # Remove everything that is not from a package or not as it was installed
+    dirs = {x for name in order for x in packages[name]['dirs']}
+    old_signatures: dict[str, list[int]] = installed['files']
+    signatures: dict[str, list[int]] = {}
+    present_dirs = set()
+    for dirpath, dirnames, filenames in os.walk(dest_dir):
+        for x in tuple(dirnames):
+            path = os.path.join(dirpath, x)
+            if os.path.islink(path):
+                dirnames.remove(x)
+                filenames.append(x)
+            elif (name := os.path.relpath(path, dest_dir)) in dirs:
+                present_dirs.add(name)
+            else:
+                dirnames.remove(x)
+                rmtree(path)
+        for x in filenames:
+            path = os.path.join(dirpath, x)
+            name = os.path.relpath(path, dest_dir)
+            if name in owners and (sig := old_signatures.get(name)) is not None and sig == installed_file_signature(path):
+                signatures[name] = sig
+            else:
+                os.unlink(path)
+    for x in sorted(dirs - present_dirs):
+        os.makedirs(os.path.join(dest_dir, x), exist_ok=True)
+    changed_packages = frozenset(changed)
+    pkg_paths = {dep.name: pkg_path(dep) for dep in which_deps}
+    for x, owner in owners.items():
+        if owner in changed_packages or old_owners.get(x) != owner or x not in signatures:
+            dest = os.path.join(dest_dir, x)
+            lcopy(os.path.join(pkg_paths[owner], x), dest)
+            signatures[x] = installed_file_signature(dest)
+    os.makedirs(INSTALLED_STATE_DIR, exist_ok=True)
+    atomic_write(installed_state_path(dest_dir), json.dumps({'packages': packages, 'order': order, 'files': signatures}))
+
+
+def init_env(which_deps: None | Sequence[Dependency] = None, overlay: bool = False) -> str:
+    ''' Populate PREFIX with the specified packages. When overlay is True and
+    possible, they are mounted as an overlay and the directory containing its
+    upper layer is returned. '''
     if which_deps is None:
         which_deps = read_deps(True)
+    if overlay and can_isolate_builds():
+        ensure_clear_dir(PREFIX)
+        if scratch := mount_packages(which_deps):
+            print('Mounted packages as an overlay at', PREFIX)
+            return scratch
     install_packages(which_deps)
+    return ''
 
 
 def accept_func_from_names(names):
@@ -180,39 +608,96 @@ def accept_func_from_names(names):
     return ffunc
 
 
+def dedup_built_packages(which_deps: Sequence[Dependency]) -> None:
+    # Hard links survive syncing packages to and from VMs, since rsync is
+    # run with -H, and exporting them, since tar stores them only once
+    pkg_paths = [pkg_path(dep) for dep in which_deps if os.path.exists(pkg_path(dep))]
+    if saved := dedup_packages(pkg_paths):
+        print(f'Linked identical files in packages, saving {saved / 1024**2:.1f} MB')
+
+
+def verify_packages(which_deps: Sequence[Dependency]) -> None:
+    failed = False
+    for dep in which_deps:
+        if os.path.exists(pkg_path(dep)):
+            if problems := verify_package(pkg_path(dep)):
+                failed = True
+                print(f'\x1b[31m{dep.name}\x1b[m', *problems[:10], sep='\n  ')
+                if len(problems) > 10:
+                    print(f'  and {len(problems) - 10} more')
+    if failed:
+        raise SystemExit(1)
+    print('All packages match their manifests')
+
+
 def main(parsed_args: Any) -> None:
-    accept_func = unbuilt
     all_deps = read_deps(True)
+    if getattr(parsed_args, 'verify', False):
+        return verify_packages(all_deps)
+    if getattr(parsed_args, 'dedup', False):
+        return dedup_built_packages(all_deps)
+    if getattr(parsed_args, 'resume', '') and not parsed_args.dependencies:
+        parsed_args.dependencies = [parsed_args.resume]
     all_dep_names = frozenset({d.name for d in all_deps})
     all_dep_names_lower = frozenset({d.name.lower() for d in all_deps})
     qt_webengine_is_used('qt-webengine' in all_dep_names)
+    graph = dependency_graph(all_deps)
+    build_keys = compute_build_keys(all_deps, graph)
     if parsed_args.dependencies:
         accept_func = accept_func_from_names(parsed_args.dependencies)
         if (frozenset(parsed_args.dependencies) - {'qt'}) - all_dep_names - all_dep_names_lower:
             raise SystemExit('Unknown dependencies: {}'.format(
                 frozenset(parsed_args.dependencies) - all_dep_names))
+    else:
+        def accept_func(dep: Dependency) -> bool:
+            if reason := cache_miss_reason(dep, build_keys[dep.name]):
+                print(f'{dep.name}: cache miss, {reason}')
+            return bool(reason)
     deps_to_build = tuple(filter(accept_func, all_deps))
+    if not parsed_args.dependencies and (num := len(all_deps) - len(deps_to_build)):
+        print(f'{num} dependencies are up to date')
     if not deps_to_build:
-        if accept_func is unbuilt:
+        if not parsed_args.dependencies:
             print('No unbuilt dependencies left')
             raise SystemExit(0)
         raise SystemExit('No buildable deps were specified')
+    inputs = transitive_inputs(graph)
+    jobs = getattr(parsed_args, 'jobs', 1)
+    scheduler = Scheduler(
+        deps_to_build, inputs, jobs, os.path.join(WORKER_DIR, 'logs'), BuildHistory(os.path.join(PKG, 'build-history.json')),
+        ram_budget=int(getattr(parsed_args, 'ram_budget', 0) * 1024**3))
+    scheduler.print_plan(verbose=getattr(parsed_args, 'plan', False))
+    if getattr(parsed_args, 'plan', False):
+        return
     names_of_deps_to_build = frozenset({d.name for d in deps_to_build})
     other_deps = [dep for dep in all_deps if dep.name not in names_of_deps_to_build]
-    init_env(other_deps)
-    ensure_downloaded()
-
-    built_names = set()
-    for i, dep in enumerate(deps_to_build):
-        set_title(f'Building {dep.name} -- {i+1} of {len(deps_to_build)}')
+    overlay = getattr(parsed_args, 'overlay_prefix', False)
+    overlay_scratch = init_env(other_deps, overlay)
+    # With a source mirror on the build host, fetch only what is needed
+    ensure_downloaded(deps_to_build if mirror_url() else None)
+    if setup_compiler_cache():
+        print('Caching compiler output in', CCACHE_DIR)
+
+    isolate = jobs > 1 and can_isolate_builds()
+    if jobs > 1 and not isolate:
+        print('Cannot give concurrent builds private views of PREFIX here, they will share it', file=sys.stderr)
+
+    def build(dep: Dependency) -> None:
+        view = ''
+        if isolate:
+            view = use_private_prefix(tuple(d for d in all_deps if d.name in inputs[dep.name]), overlay)
         try:
-            build_dep(dep, parsed_args)
-            built_names.add(dep.name)
-            print(f'\x1b[36m{dep.name} successfully built!\x1b[m')
+            build_dep(dep, parsed_args, build_key=build_keys[dep.name])
         finally:
-            remaining = tuple(d.name for d in deps_to_build if d.name not in built_names)
-            if remaining:
-                print('Remaining deps:', ', '.join(remaining))
+            if view:
+                release_private_prefix(view)
+
+    # Bound the total number of compile jobs across all concurrent builds
+    with jobserver(cpu_count() or 1):
+        scheduler(build)
+    dedup_built_packages(all_deps)
 
     # After a successful build, remove the unneeded sw dir
+    if overlay_scratch:
+        unmount_packages(overlay_scratch)
     rmtree(PREFIX)
@@ -2,28 +2,57 @@
 # vim:fileencoding=utf-8
 # License: GPLv3 Copyright: 2019, Kovid Goyal <kovid at kovidgoyal.net>
 
+import gzip
 import hashlib
+import io
 import json
 import os
 import re
+import shutil
+import sqlite3
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
 import time
-from base64 import standard_b64decode
-from contextlib import suppress
-from dataclasses import dataclass, field
+import zipfile
+from base64 import standard_b64decode, standard_b64encode
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from dataclasses import asdict, dataclass, field
 from functools import lru_cache
-from itertools import count
+from itertools import count, islice
 from typing import Any, NamedTuple
 from urllib.error import HTTPError
-from urllib.request import urlopen, urlretrieve
+from urllib.parse import urljoin, urlparse
+from urllib.request import Request, urlopen
 
 import tomllib
 
 from .constants import OS_NAME, SOURCES, SRC, iswindows
 
 DOWNLOAD_RETRIES = 3
+# The number of files downloaded concurrently and the maximum number of
+# connections made to any single host, to stay within its rate limits
+DOWNLOAD_WORKERS = 8
+CONNECTIONS_PER_HOST = 3
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+DOWNLOAD_TIMEOUT = 60
+# Cached metadata older than this is revalidated with the server
+METADATA_MAX_AGE = 24 * 3600
+METADATA_WORKERS = 16
+HASH_CHUNK_SIZE = 1024 * 1024
+VERIFIED_INDEX_NAME = '.verified.json'
+# Incomplete downloads are stored with this suffix so they can be resumed
+PARTIAL_DOWNLOAD_SUFFIX = '.part'
+SOURCE_STORE_NAME = '.store'
+# Limits on the size and age of sources in the store that are not in use,
+# override with BYPY_SOURCES_CACHE_SIZE, in bytes with an optional K, M or G
+# suffix, and BYPY_SOURCES_CACHE_DAYS
+SOURCE_STORE_SIZE = 40 * 1024**3
+SOURCE_STORE_DAYS = 180
 
 # data tables {{{
 LICENSE_INFORMATION = {
@@ -163,43 +192,212 @@ def cache_dir() -> str:
     return ans
 
 
+class MetadataStore:
+    ''' Responses to metadata requests, stored in a single SQLite database.
+    Responses older than max_age are revalidated with conditional requests
+    using their ETag and Last-Modified headers. '''
+
+    def __init__(self, path: str, max_age: float = METADATA_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.conn: sqlite3.Connection | None = None
+
+    def db(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, etag TEXT NOT NULL,'
+                ' last_modified TEXT NOT NULL, fetched_at REAL NOT NULL, data BLOB NOT NULL)')
+        return self.conn
+
+    def cached(self, url: str) -> tuple[bytes, str, str, float] | None:
+        with self.lock:
+            return self.db().execute(
+                'SELECT data, etag, last_modified, fetched_at FROM responses WHERE url=?', (url,)).fetchone()
+
+    def store(self, url: str, data: bytes, etag: str, last_modified: str) -> None:
+        with self.lock:
+            self.db().execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)', (url, etag, last_modified, time.time(), data))
+
+    def is_fresh(self, url: str) -> bool:
+        row = self.cached(url)
+        return row is not None and time.time() - row[3] < self.max_age
+
+    def get(self, url: str, max_age: float | None = None) -> bytes:
+        row = self.cached(url)
+        if row is not None and time.time() - row[3] < (self.max_age if max_age is None else max_age):
+            return row[0]
+        req = Request(url)
+        if row is not None:
+            if row[1]:
+                req.add_header('If-None-Match', row[1])
+            if row[2]:
+                req.add_header('If-Modified-Since', row[2])
+        try:
+            with connection_to(url), urlopen(req, timeout=DOWNLOAD_TIMEOUT) as res:
+                data = res.read()
+                self.store(url, data, res.headers.get('ETag', ''), res.headers.get('Last-Modified', ''))
+                return data
+        except HTTPError as err:
+            if row is None:
+                raise
+            if err.code == 304:
+                self.store(url, row[0], err.headers.get('ETag', row[1]), err.headers.get('Last-Modified', row[2]))
+                return row[0]
+        except OSError:
+            if row is None:
+                raise
+        # Revalidation failed, for example when offline, use the stale data
+        return row[0]
+
+    def prefetch(self, urls: Iterable[str]) -> None:
+        ''' Fetch all urls that are not already fresh concurrently. Errors are
+        ignored here, they are reported when the data is actually needed. '''
+        def fetch(url: str) -> None:
+            with suppress(Exception):
+                self.get(url)
+
+        if needed := [url for url in urls if not self.is_fresh(url)]:
+            with ThreadPoolExecutor(max_workers=METADATA_WORKERS, thread_name_prefix='Metadata') as executor:
+                tuple(executor.map(fetch, needed))
+
+
+@lru_cache(2)
+def metadata_store() -> MetadataStore:
+    return MetadataStore(os.path.join(cache_dir(), 'metadata.sqlite'))
+
+
+def pypi_metadata_url(name: str, version: str) -> str:
+    return f'https://pypi.org/pypi/{name}/{version}/json'
+
+
 @lru_cache()
 def get_pypi_metadata(name: str, version: str) -> dict[str, Any]:
-    cached = os.path.join(cache_dir(), f'pypi-{name}-{version}.json')
-    with suppress(FileNotFoundError), open(cached, 'rb') as f:
-        return json.loads(f.read())
     try:
-        with urlopen(f'https://pypi.org/pypi/{name}/{version}/json') as f:
-            raw = f.read()
-            with open(cached, 'wb') as c:
-                c.write(raw)
-            return json.loads(raw)
+        return json.loads(metadata_store().get(pypi_metadata_url(name, version)))
     except Exception as err:
         raise SystemExit(f'Could not get pypi package: {name}/{version} with error: {err}') from err
 
 
+def prefetch_pypi_metadata(deps: Iterable['Dependency']) -> None:
+    ''' Fill the metadata cache for all the specified PyPI dependencies at once '''
+    metadata_store().prefetch(pypi_metadata_url(d.name, d.version) for d in deps if d.ecosystem == 'pypi')
+
+
 GO_PRIVATE_PACKAGES: dict[str, str] = {
 }
 
 
+GOPROXY_DEFAULT = 'https://proxy.golang.org'
+LICENSE_FILE_NAME = re.compile(r'(?:UN)?LICEN[CS]E(?:[-._].*)?|COPYING(?:[-._].*)?', re.IGNORECASE)
+# Licences that have a title are identified by it, and the title has to be in
+# the first lines of the text, since licence texts mention other licences, for
+# example, the GPL mentions the Affero GPL. The earliest title wins.
+LICENSE_TITLE_LINES = 10
+LICENSE_TITLES: tuple[tuple[str, re.Pattern[str]], ...] = tuple((k, re.compile(v)) for k, v in (
+    ('Apache-2.0', r'apache license,? version 2\.0\b'),
+    ('MPL-2.0', r'mozilla public license,? version 2\.0\b'),
+    ('MPL-1.1', r'mozilla public license,? version 1\.1\b'),
+    ('AGPL-3.0-only', r'gnu affero general public license,? version 3\b'),
+    ('LGPL-3.0-only', r'gnu lesser general public license,? version 3\b'),
+    ('LGPL-2.1-only', r'gnu lesser general public license,? version 2\.1\b'),
+    ('LGPL-2.0-only', r'gnu library general public license,? version 2\b'),
+    ('GPL-3.0-only', r'gnu general public license,? version 3\b'),
+    ('GPL-2.0-only', r'gnu general public license,? version 2\b'),
+    ('CC0-1.0', r'\bcc0 1\.0 universal\b'),
+))
+# Licences without a title are identified by phrases, all of which must be
+# present in the text. More specific licences must come before the ones they
+# contain the phrases of.
+LICENSE_SIGNATURES: tuple[tuple[str, tuple[str, ...]], ...] = (
+    ('ISC', ('permission to use, copy, modify, and/or distribute this software for any purpose',)),
+    ('MIT', ('permission is hereby granted, free of charge', 'the above copyright notice and this permission notice shall be included')),
+    ('BSD-4-Clause', ('redistribution and use in source and binary forms', 'all advertising materials mentioning features')),
+    ('BSD-3-Clause', ('redistribution and use in source and binary forms', 'to endorse or promote products derived from this software')),
+    ('BSD-2-Clause', ('redistribution and use in source and binary forms',)),
+    ('Unlicense', ('this is free and unencumbered software released into the public domain',)),
+)
+
+
+def go_proxy_url() -> str:
+    ''' The GOPROXY protocol server to get Go modules from. BYPY_GOPROXY
+    overrides GOPROXY, for example, to use a local stand-in when offline. Only
+    the first http(s) or file URL in the list is used. '''
+    for q in (os.environ.get('BYPY_GOPROXY', ''), os.environ.get('GOPROXY', '')):
+        for x in re.split(r'[,|]', q):
+            if x.strip().startswith(('https://', 'http://', 'file://')):
+                return x.strip().rstrip('/')
+    return GOPROXY_DEFAULT
+
+
+def go_module_url(name: str, version: str, ext: str) -> str:
+    # See https://go.dev/ref/mod#goproxy-protocol uppercase letters are
+    # escaped as an exclamation mark followed by the lowercase letter
+    def escape(x: str) -> str:
+        return re.sub(r'[A-Z]', lambda m: '!' + m.group().lower(), x)
+    return f'{go_proxy_url()}/{escape(name)}/@v/{escape(version)}.{ext}'
+
+
+def go_dirhash(zf: zipfile.ZipFile) -> str:
+    ''' The h1: hash used by go.sum for the files in a module zip '''
+    h = hashlib.sha256()
+    for name in sorted(zf.namelist()):
+        h.update(f'{hashlib.sha256(zf.read(name)).hexdigest()}  {name}\n'.encode())
+    return 'h1:' + standard_b64encode(h.digest()).decode()
+
+
+def detect_license(text: str) -> str:
+    lines = (x for x in text.lower().splitlines() if x.strip())
+    title = ' '.join(' '.join(islice(lines, LICENSE_TITLE_LINES)).split())
+    found = sorted((m.start(), spdx_id) for spdx_id, pat in LICENSE_TITLES if (m := pat.search(title)))
+    if found:
+        return found[0][1]
+    text = ' '.join(text.lower().split())
+    for spdx_id, phrases in LICENSE_SIGNATURES:
+        if all(p in text for p in phrases):
+            return spdx_id
+    return ''
+
+
+def license_of_go_module(zf: zipfile.ZipFile) -> str:
+    ans = []
+    for name in zf.namelist():
+        # Files in the module zip are named module@version/path
+        path = name.partition('@')[2].partition('/')[2]
+        if '/' not in path and LICENSE_FILE_NAME.fullmatch(path):
+            if (q := detect_license(zf.read(name).decode('utf-8', 'replace'))) and q not in ans:
+                ans.append(q)
+    return ' AND '.join(sorted(ans))
+
+
 @lru_cache()
-def get_go_metadata(name: str, version: str) -> dict[str, str]:
-    # Stupidly pkg.go.dev has no API: https://github.com/golang/go/issues/36785
-    # you can get hash using: https://proxy.golang.org/{name}/@v/v{version}.info but not bothering
-    # see endpoints at https://go.dev/ref/mod#goproxy-protocol
-    cached = os.path.join(cache_dir(), f'go-{name.replace("/", "_")}-{version}.json')
-    with suppress(FileNotFoundError), open(cached, 'rb') as f:
-        return json.loads(f.read())
+def get_go_metadata(name: str, version: str, go_sum_hash: str = '') -> dict[str, str]:
+    ''' Get the licence of a Go module by downloading it from the GOPROXY and
+    examining its licence files. go_sum_hash is the h1: hash of the module zip
+    from go.sum, used to verify the download. Results are cached, as module
+    versions are immutable. '''
+    store = metadata_store()
     try:
-        with urlopen(f'https://pkg.go.dev/{name}') as f:
-            raw = f.read().decode()
-            if m := re.search(r'data-test-id="UnitHeader-license".+?>(.+?)<', raw, flags=re.DOTALL):
-                ans = {'spdx_id': m.group(1).strip()}
-            else:
-                raise SystemExit(f'Could not find license for go package: {name}/{version}')
-            with open(cached, 'w') as c:
-                c.write(json.dumps(ans))
-            return ans
+        info = json.loads(store.get(go_module_url(name, f'v{version}', 'info'), max_age=float('inf')))
+        url = go_module_url(name, info['Version'], 'zip')
+        key = url + '#license'
+        if (row := store.cached(key)) is not None:
+            return json.loads(row[0])
+        with tempfile.TemporaryFile() as f:
+            with connection_to(url), urlopen(url, timeout=DOWNLOAD_TIMEOUT) as res:
+                shutil.copyfileobj(res, f)
+            with zipfile.ZipFile(f) as zf:
+                if go_sum_hash and (actual := go_dirhash(zf)) != go_sum_hash:
+                    raise SystemExit(f'The hash of the go module: {name}/{version} {actual} does not match the hash in go.sum: {go_sum_hash}')
+                if not (spdx_id := license_of_go_module(zf)):
+                    raise SystemExit(f'Could not find license for go package: {name}/{version}')
+        ans = {'spdx_id': spdx_id, 'version': info['Version'], 'time': info.get('Time', '')}
+        store.store(key, json.dumps(ans).encode(), '', '')
+        return ans
+    except SystemExit:
+        raise
     except Exception as err:
         raise SystemExit(f'Could not get go package: {name}/{version} with error: {err}') from err
 
@@ -222,6 +420,7 @@ class Dependency:
     _spdx_license_id: str = ''
     purl: str = ''
     cpe: str = ''
+    declared_depends: tuple[str, ...] | None = None
 
     @classmethod
     def from_sources_json_entry(cls, e: dict[str, Any], global_metadata: GlobalMetadata) -> 'Dependency':
@@ -252,9 +451,15 @@ class Dependency:
             version_with_underscores=version.replace('.', '_').replace('-', '_'),
         ) for u in s['urls'])
         os = tuple(x.strip().lower() for x in e.get('os', '').split(',')) if e.get('os') else ()
+        depends = e.get('depends')
+        if isinstance(depends, str):
+            depends = depends.split(',')
+        if depends is not None:
+            depends = tuple(x.strip() for x in depends if x.strip())
         return Dependency(
             name=name, version=version, urls=urls, allowed_os_names=os, file_extension='.'+ext, cpe=cpe,
             expected_hash=s['hash'], _spdx_license_id=spdx, for_building=e.get('type') == 'build', purl=purl,
+            declared_depends=depends,
         )
 
     @classmethod
@@ -266,14 +471,14 @@ class Dependency:
                           for_building=for_building, purl=f'pkg:pypi/{name}@{version}')
 
     @classmethod
-    def from_go_sum(cls, name: str, version: str, alg: str) -> 'Dependency':
+    def from_go_sum(cls, name: str, version: str, alg: str, spdx: str = '') -> 'Dependency':
         alg, _, csum = alg.partition(':')
         if alg != 'h1':
             raise ValueError(f'Unknown checksum algorithm {alg} for go dep: {name}')
         csum = 'sha256:' + standard_b64decode(csum).hex()
         version = version[1:]
         purl = f'pkg:golang/{name}@{version}'
-        if not (spdx := GO_PRIVATE_PACKAGES.get(name, '')):
+        if not spdx and not (spdx := GO_PRIVATE_PACKAGES.get(name, '')):
             spdx = get_go_metadata(name, version)['spdx_id']
         return Dependency(
             name=name, version=version, purl=purl, ecosystem='go', expected_hash=csum, urls=('https://' + name,),
@@ -393,7 +598,7 @@ class Dependency:
                 return
         raise ValueError(f'No download URLs for {self.name}@{self.version}')
 
-    def ensure_pypi_downloaded(self) -> str:
+    def ensure_pypi_downloaded(self, progress: 'DownloadProgress | None' = None) -> str:
         filename = self._filename
         path = os.path.join(SOURCES, filename)
         if os.path.exists(path):
@@ -401,34 +606,46 @@ class Dependency:
         if not self.file_extension:
             q = filename
             for x in os.listdir(SOURCES):
-                if x.startswith(q):
+                if x.startswith(q) and not x.endswith(PARTIAL_DOWNLOAD_SUFFIX):
                     self.file_extension = x[len(filename):]
                     return os.path.join(SOURCES, x)
         self.ensure_pypi_download_data()
         path = os.path.join(SOURCES, self._filename)
-        download_pkg(self, path)
+        download_pkg(self, path, progress)
         return path
 
+    def new_hash(self) -> 'hashlib._Hash':
+        return hashlib.new(self.expected_hash.partition(':')[0].lower())
+
+    def hash_matches(self, h: 'hashlib._Hash') -> bool:
+        return h.hexdigest() == self.expected_hash.partition(':')[2].strip()
+
     def verify_hash(self, path: str) -> bool:
+        if verified_files.is_verified(path, self.expected_hash):
+            return True
         try:
             f = open(path, 'rb')
         except FileNotFoundError:
             return False
-        alg, q = self.expected_hash.partition(':')[::2]
-        q = q.strip()
+        h = self.new_hash()
         with f:
-            h = getattr(hashlib, alg.lower())
-            fhash = h(f.read()).hexdigest()
-            return fhash == q
+            while chunk := f.read(HASH_CHUNK_SIZE):
+                h.update(chunk)
+        if self.hash_matches(h):
+            verified_files.mark_verified(path, self.expected_hash)
+            return True
+        return False
 
-    def ensure_downloaded(self) -> str:
+    def ensure_downloaded(self, progress: 'DownloadProgress | None' = None) -> str:
         if self.ecosystem == 'pypi':
-            return self.ensure_pypi_downloaded()
+            return self.ensure_pypi_downloaded(progress)
         filename = self.filename
         path = os.path.join(SOURCES, filename)
         if self.verify_hash(path):
+            if not os.path.exists(source_store.path_for(self.expected_hash)):
+                source_store.add(path, self.expected_hash)
             return path
-        download_pkg(self, path)
+        download_pkg(self, path, progress)
         return path
 
 
@@ -470,16 +687,74 @@ def read_go_deps() -> list[Dependency]:
                     raise ValueError(f'Unknown hash type: {q} for package: {name}')
             else:
                 package_hashes[name] = version, alg
-    for name in set(package_hashes) | set(package_go_mod_hashes):
-        version, alg = package_hashes.get(name) or package_go_mod_hashes[name]
-        ans.append(Dependency.from_go_sum(name, version, alg))
+    modules = {name: package_hashes.get(name) or package_go_mod_hashes[name] for name in set(package_hashes) | set(package_go_mod_hashes)}
+
+    def spdx_of(name: str) -> str:
+        if spdx := GO_PRIVATE_PACKAGES.get(name, ''):
+            return spdx
+        version, alg = modules[name]
+        # Only the hash of the module zip, not of go.mod, can be verified
+        return get_go_metadata(name, version[1:], alg if name in package_hashes else '')['spdx_id']
+
+    with ThreadPoolExecutor(max_workers=METADATA_WORKERS, thread_name_prefix='GoMetadata') as executor:
+        licenses = dict(zip(modules, executor.map(spdx_of, modules)))
+    for name, (version, alg) in modules.items():
+        ans.append(Dependency.from_go_sum(name, version, alg, licenses[name]))
+    return ans
+
+
+
+DEPS_CACHE_VERSION = 1
+
+
+def deps_cache_key(src: str) -> list[Any]:
+    ''' Identifies the inputs to parse_deps(), including the code doing the parsing '''
+    ans: list[Any] = [DEPS_CACHE_VERSION, OS_NAME]
+    for x in (os.path.join(src, 'bypy', 'sources.json'), os.path.join(src, 'pyproject.toml'), os.path.abspath(__file__)):
+        try:
+            st = os.stat(x)
+        except FileNotFoundError:
+            ans.append([x])
+        else:
+            ans.append([x, st.st_size, st.st_mtime_ns])
     return ans
 
 
+def read_cached_deps(cache_path: str, key: list[Any]) -> tuple[Dependency, ...] | None:
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    if cached.get('key') != key:
+        return None
+    ans = []
+    for d in cached['deps']:
+        d['allowed_os_names'], d['urls'] = tuple(d['allowed_os_names']), tuple(d['urls'])
+        if d['declared_depends'] is not None:
+            d['declared_depends'] = tuple(d['declared_depends'])
+        ans.append(Dependency(**d))
+    return tuple(ans)
+
 
 @lru_cache(2)
 def read_deps(only_buildable: bool = False) -> tuple[Dependency, ...]:
+    data = parse_deps()
+    if only_buildable:
+        return tuple(d for d in data if d.is_buildable())
+    return data
+
+
+@lru_cache(2)
+def parse_deps() -> tuple[Dependency, ...]:
+    ''' Parse sources.json and pyproject.toml into the list of dependencies.
+    The result is cached in a file keyed on the mtimes of the inputs, so
+    that commands that only need the list start quickly. '''
     src = SRC if os.path.exists(SRC) else os.getcwd()
+    key = deps_cache_key(src)
+    cache_path = os.path.join(cache_dir(), 'deps-' + hashlib.sha256(os.path.abspath(src).encode()).hexdigest()[:16] + '.json')
+    if (cached := read_cached_deps(cache_path, key)) is not None:
+        return cached
     with open(os.path.join(src, 'bypy', 'sources.json')) as f:
         base_data = json.load(f)
     dmap = {q['name'].partition(' ')[0]: q for q in base_data}
@@ -497,8 +772,15 @@ def read_deps(only_buildable: bool = False) -> tuple[Dependency, ...]:
         if data[-1].name == 'python':
             data.extend(python_build_deps)
     data.extend(python_runtime_deps)
-    if only_buildable:
-        return tuple(d for d in data if d.is_buildable())
+    deps = []
+    for d in data:
+        # The ids are assigned afresh when loading, so that they are unique in this process
+        q = asdict(d)
+        del q['unique_id_in_list']
+        deps.append(q)
+    from .utils import atomic_write
+    with suppress(OSError):
+        atomic_write(cache_path, json.dumps({'key': key, 'deps': deps}, separators=(',', ':')))
     return tuple(data)
 
 
@@ -512,31 +794,309 @@ def python_version() -> tuple[int, int]:
 
 
 def sha256_for_path(path: str) -> str:
+    h = hashlib.sha256()
     with open(path, 'rb') as f:
-        return hashlib.sha256(f.read()).hexdigest()
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class VerifiedFiles:
+    ''' An index of the files in a sources dir, SOURCES by default, whose
+    hashes have already been verified. Entries are keyed by the path of the
+    file relative to the sources dir and record its size, mtime and inode, so
+    a file that is changed or replaced is hashed again. '''
+
+    def __init__(self, sources_dir: str = '') -> None:
+        self.sources_dir = sources_dir
+        self.lock = threading.Lock()
+        self.entries: dict[str, list[Any]] | None = None
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.sources_dir or SOURCES, VERIFIED_INDEX_NAME)
+
+    def name_for(self, path: str) -> str:
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.sources_dir or SOURCES))
 
+    def path_for(self, name: str) -> str:
+        return os.path.join(self.sources_dir or SOURCES, name)
 
-def reporthook():
-    start_time = time.monotonic()
+    def load(self) -> dict[str, list[Any]]:
+        if self.entries is None:
+            self.entries = {}
+            with suppress(FileNotFoundError, ValueError), open(self.index_path, 'rb') as f:
+                self.entries = json.loads(f.read())
+        return self.entries
 
-    def report(count, block_size, total_size):
-        if count == 0:
+    def key_for(self, path: str, expected_hash: str) -> list[Any]:
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns, st.st_ino, expected_hash]
+
+    def is_verified(self, path: str, expected_hash: str) -> bool:
+        with self.lock:
+            try:
+                return self.load().get(self.name_for(path)) == self.key_for(path, expected_hash)
+            except OSError:
+                return False
+
+    def verified_hash(self, path: str) -> str:
+        ''' The hash the file at path was verified against, if it has not
+        changed since '''
+        with self.lock:
+            try:
+                entry = self.load().get(self.name_for(path))
+                return entry[-1] if entry and entry == self.key_for(path, entry[-1]) else ''
+            except OSError:
+                return ''
+
+    def mark_verified(self, path: str, expected_hash: str) -> None:
+        from .utils import atomic_write
+        with self.lock:
+            entries = self.load()
+            entries[self.name_for(path)] = self.key_for(path, expected_hash)
+            for x in tuple(entries):
+                if not os.path.exists(self.path_for(x)):
+                    del entries[x]
+            atomic_write(self.index_path, json.dumps(entries, indent=2))
+
+
+verified_files = VerifiedFiles()
+
+
+def source_store_limits() -> tuple[int, float]:
+    size = os.environ.get('BYPY_SOURCES_CACHE_SIZE', '').strip().upper()
+    max_size = SOURCE_STORE_SIZE
+    if size:
+        mult = {'K': 1024, 'M': 1024**2, 'G': 1024**3}.get(size[-1], 1)
+        max_size = int(float(size.rstrip('KMGB') or 0) * mult)
+    days = float(os.environ.get('BYPY_SOURCES_CACHE_DAYS', SOURCE_STORE_DAYS))
+    return max_size, days * 24 * 3600
+
+
+class SourceStore:
+    ''' Downloaded sources are stored in SOURCES/.store named by their hash,
+    the files named after the dependencies in SOURCES are hard links into it.
+    This allows sources that are not currently needed, say when switching
+    branches, to be kept without knowing their names. They are evicted,
+    least recently used first, only when they exceed the age and size limits. '''
+
+    def __init__(self, sources_dir: str = '') -> None:
+        self.sources_dir = sources_dir
+        self.lock = threading.Lock()
+        self.last_used: dict[str, float] | None = None
+
+    @property
+    def store_dir(self) -> str:
+        return os.path.join(self.sources_dir or SOURCES, SOURCE_STORE_NAME)
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.store_dir, 'last-used.json')
+
+    def path_for(self, expected_hash: str) -> str:
+        alg, _, q = expected_hash.partition(':')
+        return os.path.join(self.store_dir, f'{alg.lower()}-{q.strip()}')
+
+    def load(self) -> dict[str, float]:
+        if self.last_used is None:
+            self.last_used = {}
+            with suppress(FileNotFoundError, ValueError), open(self.index_path, 'rb') as f:
+                self.last_used = json.loads(f.read())
+        return self.last_used
+
+    def save(self) -> None:
+        from .utils import atomic_write
+        atomic_write(self.index_path, json.dumps(self.load(), indent=2, sort_keys=True))
+
+    def mark_used(self, path: str) -> None:
+        with self.lock:
+            self.load()[os.path.basename(path)] = time.time()
+            self.save()
+
+    def restore(self, expected_hash: str, path: str) -> bool:
+        ''' Link the stored source with expected_hash to path, if present '''
+        if not expected_hash:
+            return False
+        src = self.path_for(expected_hash)
+        try:
+            with suppress(FileNotFoundError):
+                os.remove(path)
+            os.link(src, path)
+        except OSError:
+            return False
+        self.mark_used(src)
+        verified_files.mark_verified(path, expected_hash)
+        return True
+
+    def add(self, path: str, expected_hash: str) -> None:
+        if not expected_hash:
+            return
+        dest = self.path_for(expected_hash)
+        if not os.path.exists(dest):
+            os.makedirs(self.store_dir, exist_ok=True)
+            try:
+                os.link(path, dest)
+            except FileExistsError:
+                pass
+            except OSError:
+                # Hard links are not supported on this filesystem
+                return
+        self.mark_used(dest)
+
+    def evict(self) -> None:
+        ''' Remove stored sources that are not linked from SOURCES once they
+        are older than the age limit or the store is larger than the size limit '''
+        if not os.path.isdir(self.store_dir):
             return
-        duration = time.monotonic() - start_time
-        if duration == 0:
+        max_size, max_age = source_store_limits()
+        now = time.time()
+        with self.lock:
+            last_used = self.load()
+            unused, total = [], 0
+            for x in os.listdir(self.store_dir):
+                path = os.path.join(self.store_dir, x)
+                if x == os.path.basename(self.index_path) or not os.path.isfile(path):
+                    continue
+                st = os.stat(path)
+                total += st.st_size
+                if st.st_nlink > 1:
+                    last_used[x] = now
+                else:
+                    unused.append((last_used.setdefault(x, st.st_mtime), st.st_size, x))
+            for used_at, size, x in sorted(unused):
+                if now - used_at > max_age or total > max_size:
+                    print('Removing unused source file from store:', x)
+                    os.remove(os.path.join(self.store_dir, x))
+                    total -= size
+                    last_used.pop(x, None)
+            for x in tuple(last_used):
+                if not os.path.exists(os.path.join(self.store_dir, x)):
+                    del last_used[x]
+            self.save()
+
+
+source_store = SourceStore()
+
+
+class DownloadProgress:
+    ''' A single status line showing the combined progress of all running
+    downloads. Messages must be printed via log() so that they do not get
+    mixed up with the status line. '''
+
+    def __init__(self, num_of_files: int = 1):
+        self.lock = threading.Lock()
+        self.num_of_files = num_of_files
+        self.num_finished = 0
+        self.num_of_bytes = 0
+        self.start_time = time.monotonic()
+        self.last_update = 0.
+        self.is_tty = sys.stdout.isatty()
+        self.status_shown = False
+
+    def clear_status(self) -> None:
+        if self.status_shown:
+            sys.stdout.write('\r\x1b[K')
+            self.status_shown = False
+
+    def log(self, *args: Any, file: Any = None) -> None:
+        with self.lock:
+            self.clear_status()
+            sys.stdout.flush()
+            print(*args, file=file or sys.stdout, flush=True)
+
+    def received(self, num_of_bytes: int) -> None:
+        with self.lock:
+            self.num_of_bytes += num_of_bytes
+            self.show_status()
+
+    def file_finished(self) -> None:
+        with self.lock:
+            self.num_finished += 1
+            if self.num_of_bytes:
+                self.show_status(force=True)
+
+    def show_status(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and (not self.is_tty or now - self.last_update < 0.2):
             return
-        progress_size = int(count * block_size)
-        speed = int(progress_size / (1024 * duration))
-        if total_size == -1:
-            msg = '%d MB, %d KB/s, %d seconds passed' % (
-                progress_size / (1024 * 1024), speed, duration)
+        self.last_update = now
+        duration = max(now - self.start_time, 0.001)
+        msg = '%d of %d files, %d MB, %d KB/s, %d seconds passed' % (
+            self.num_finished, self.num_of_files, self.num_of_bytes / (1024 * 1024),
+            self.num_of_bytes / (1024 * duration), duration)
+        if self.is_tty:
+            sys.stdout.write('\r\x1b[K...' + msg)
+            self.status_shown = True
         else:
-            percent = int(count * block_size * 100 / total_size)
-            msg = "%d%%, %d MB, %d KB/s, %d seconds passed" % (
-                percent, progress_size / (1024 * 1024), speed, duration)
-        sys.stdout.write('\r...' + msg)
+            sys.stdout.write('...' + msg + '\n')
         sys.stdout.flush()
-    return report
+
+    def finish(self) -> None:
+        with self.lock:
+            if self.status_shown:
+                sys.stdout.write('\n')
+                sys.stdout.flush()
+                self.status_shown = False
+
+
+host_connection_limits: dict[str, threading.BoundedSemaphore] = {}
+host_connection_limits_lock = threading.Lock()
+
+
+@contextmanager
+def connection_to(url: str) -> Iterator[None]:
+    host = urlparse(url).hostname or ''
+    with host_connection_limits_lock:
+        sem = host_connection_limits.get(host)
+        if sem is None:
+            sem = host_connection_limits[host] = threading.BoundedSemaphore(CONNECTIONS_PER_HOST)
+    with sem:
+        yield
+
+
+def open_url(url: str, offset: int = 0) -> Any:
+    ''' Open url, asking for the data from offset onwards. Returns None if
+    the server says offset is past the end of the file. '''
+    req = Request(url)
+    if offset:
+        req.add_header('Range', f'bytes={offset}-')
+    try:
+        return urlopen(req, timeout=DOWNLOAD_TIMEOUT)
+    except HTTPError as err:
+        if err.code == 416 and offset:
+            return None
+        raise
+
+
+def fetch(url: str, path: str, new_hash: Callable[[], 'hashlib._Hash'], progress: DownloadProgress) -> 'hashlib._Hash':
+    ''' Download url to path, resuming the partial download in path, if any,
+    when the server supports range requests. Returns the hash of the
+    downloaded data, updated as data is received so that the file does not
+    have to be read again to verify it. '''
+    h = new_hash()
+    try:
+        offset = os.path.getsize(path)
+    except FileNotFoundError:
+        offset = 0
+    with connection_to(url):
+        if (res := open_url(url, offset)) is None:
+            offset = 0
+            res = open_url(url)
+        with res:
+            mode = 'wb'
+            if offset and res.status == 206 and res.headers.get('Content-Range', '').startswith(f'bytes {offset}-'):
+                progress.log(f'Resuming download of {os.path.basename(path)} from {offset / (1024 * 1024):.1f} MB')
+                with open(path, 'rb') as f:
+                    while chunk := f.read(HASH_CHUNK_SIZE):
+                        h.update(chunk)
+                mode = 'ab'
+            with open(path, mode) as f:
+                while chunk := res.read(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    h.update(chunk)
+                    progress.received(len(chunk))
+    return h
 
 
 def get_github_url(url):
@@ -544,56 +1104,220 @@ def get_github_url(url):
     return f'https://api.github.com/repos/{ident}/tarball'
 
 
+git_mirror_locks: dict[str, threading.Lock] = {}
+git_mirror_locks_lock = threading.Lock()
+
+
+def git(repo: str, *args: str) -> bytes:
+    return subprocess.check_output(['git', *args], cwd=repo)
+
+
+def git_has_commit(repo: str, ref: str) -> bool:
+    return subprocess.run(
+        ['git', 'rev-parse', '--verify', '--quiet', f'{ref}^{{commit}}'], cwd=repo, stdout=subprocess.DEVNULL).returncode == 0
+
+
+def ensure_git_mirror(url: str, ref: str) -> str:
+    ''' Return the path to a bare mirror of the repository at url, kept in the
+    cache dir. The mirror is created or updated, incrementally, only if it
+    does not already contain ref. '''
+    name = re.sub(r'[^a-zA-Z0-9._-]+', '_', url.partition('://')[2] or url).strip('_')
+    path = os.path.join(cache_dir(), 'git-mirrors', name + '.git')
+    with git_mirror_locks_lock:
+        lock = git_mirror_locks.setdefault(path, threading.Lock())
+    with lock:
+        if not os.path.exists(path):
+            tmp = path + '.tmp'
+            shutil.rmtree(tmp, ignore_errors=True)
+            subprocess.check_call(['git', 'clone', '--quiet', '--mirror', url, tmp])
+            os.rename(tmp, path)
+        if not git_has_commit(path, ref):
+            subprocess.check_call(['git', 'remote', 'update', '--prune'], cwd=path, stdout=subprocess.DEVNULL)
+        if not git_has_commit(path, ref):
+            # Submodules can be pinned to commits that no ref points to
+            subprocess.check_call(['git', 'fetch', '--quiet', 'origin', ref], cwd=path)
+    return path
+
+
+class GitObjectReader:
+
+    def __init__(self, repo: str):
+        self.p = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=repo, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def __call__(self, sha: str) -> bytes:
+        assert self.p.stdin is not None and self.p.stdout is not None
+        self.p.stdin.write(sha.encode() + b'\n')
+        self.p.stdin.flush()
+        size = int(self.p.stdout.readline().split()[2])
+        data = self.p.stdout.read(size)
+        self.p.stdout.read(1)
+        return data
+
+    def close(self) -> None:
+        assert self.p.stdin is not None
+        self.p.stdin.close()
+        self.p.wait()
+
+
+def git_tree_files(repo: str, url: str, commit: str, prefix: str = '') -> Iterator[tuple[str, str, str, str]]:
+    ''' Yield (path, mode, blob sha, repo) for every file in the tree of commit,
+    recursing into submodules, which are fetched into mirrors of their own '''
+    submodule_urls: dict[str, str] | None = None
+    for record in git(repo, 'ls-tree', '-r', '-z', '--full-tree', commit).split(b'\0'):
+        if not record:
+            continue
+        meta, _, rpath = record.partition(b'\t')
+        mode, kind, sha = meta.decode().split()
+        path = rpath.decode('utf-8', 'surrogateescape')
+        if kind != 'commit':
+            yield prefix + path, mode, sha, repo
+            continue
+        if submodule_urls is None:
+            submodule_urls = {}
+            names: dict[str, dict[str, str]] = {}
+            raw = git(repo, 'config', '-z', '--blob', f'{commit}:.gitmodules', '--get-regexp', r'^submodule\..*\.(path|url)$')
+            for item in raw.decode().split('\0'):
+                if item:
+                    key, _, val = item.partition('\n')
+                    sname, _, which = key[len('submodule.'):].rpartition('.')
+                    names.setdefault(sname, {})[which] = val
+            for q in names.values():
+                # relative URLs are relative to the URL of the superproject
+                submodule_urls[q['path']] = urljoin(url.rstrip('/') + '/', q['url'])
+        sub_url = submodule_urls[path]
+        yield from git_tree_files(ensure_git_mirror(sub_url, sha), sub_url, sha, prefix + path + '/')
+
+
+def write_deterministic_tarball(path: str, dname: str, files: Iterable[tuple[str, str, str, str]], mtime: int) -> None:
+    ''' Write files to a .tar.gz with sorted entries, fixed metadata and a
+    fixed gzip header, so that the same files always give the same bytes '''
+    readers: dict[str, GitObjectReader] = {}
+    seen_dirs = {''}
+
+    def tarinfo(name: str, kind: bytes = tarfile.REGTYPE, mode: int = 0o644, size: int = 0) -> tarfile.TarInfo:
+        ti = tarfile.TarInfo(f'{dname}/{name}' if name else dname)
+        ti.type, ti.mode, ti.size, ti.mtime = kind, mode, size, mtime
+        ti.uid = ti.gid = 0
+        ti.uname = ti.gname = ''
+        return ti
+
+    try:
+        with open(path, 'wb') as raw, gzip.GzipFile(filename='', mode='wb', fileobj=raw, compresslevel=9, mtime=0) as gz, \
+                tarfile.open(fileobj=gz, mode='w', format=tarfile.GNU_FORMAT) as tf:
+            tf.addfile(tarinfo('', tarfile.DIRTYPE, 0o755))
+            for name, mode, sha, repo in sorted(files):
+                parts = name.split('/')
+                for i in range(1, len(parts)):
+                    if (d := '/'.join(parts[:i])) not in seen_dirs:
+                        seen_dirs.add(d)
+                        tf.addfile(tarinfo(d, tarfile.DIRTYPE, 0o755))
+                if repo not in readers:
+                    readers[repo] = GitObjectReader(repo)
+                data = readers[repo](sha)
+                if mode == '120000':
+                    ti = tarinfo(name, tarfile.SYMTYPE, 0o777)
+                    ti.linkname = data.decode('utf-8', 'surrogateescape')
+                    tf.addfile(ti)
+                else:
+                    tf.addfile(tarinfo(name, mode=0o755 if mode == '100755' else 0o644, size=len(data)), io.BytesIO(data))
+    finally:
+        for r in readers.values():
+            r.close()
+
+
 def get_git_with_submodules(pkg: Dependency, url: str, path: str) -> None:
-    with tempfile.TemporaryDirectory() as tdir:
-        dname = f'{pkg.name}-{pkg.version}'
-        path = os.path.abspath(path)
-        subprocess.check_call(['git', 'clone', '--depth', '1', '--recurse-submodules', '--shallow-submodules', '--branch', 'v' + pkg.version, url, dname], cwd=tdir)
-        subprocess.check_call(['tar', '--exclude=.git*', '-czf', path, dname], cwd=tdir)
+    ''' Generate a tarball of the tag v<version> of the repository at url,
+    including its submodules, from mirrors kept in the cache dir '''
+    tag = f'refs/tags/v{pkg.version}'
+    repo = ensure_git_mirror(url, tag)
+    commit = git(repo, 'rev-parse', f'{tag}^{{commit}}').decode().strip()
+    mtime = int(git(repo, 'log', '-1', '--format=%ct', commit).decode())
+    # Exclude .gitignore, .gitmodules, .github, etc.
+    files = (x for x in git_tree_files(repo, url, commit) if not any(p.startswith('.git') for p in x[0].split('/')))
+    path = os.path.abspath(path)
+    tmp = path + PARTIAL_DOWNLOAD_SUFFIX
+    write_deterministic_tarball(tmp, f'{pkg.name}-{pkg.version}', files, mtime)
+    os.replace(tmp, path)
     if not pkg.verify_hash(path):
         raise SystemExit(
             f'The hash of the generated file: {os.path.basename(path)}'
             ' does not match the saved hash. It\'s sha256 is'
             f': {sha256_for_path(path)}')
-    print('Tarball with submodules generated at:', path)
 
 
-def try_once(pkg: Dependency, url: str, path: str) -> None:
+def try_once(pkg: Dependency, url: str, path: str, progress: DownloadProgress) -> None:
     if url.startswith('git-submodules:'):
-        return get_git_with_submodules(pkg, url.replace('git-submodules', 'https', 1), path)
+        get_git_with_submodules(pkg, url.replace('git-submodules', 'https', 1), path)
+        progress.log('Tarball with submodules generated at:', path)
+        return
     if url.startswith('github:'):
         url = get_github_url(url)
-    print('Downloading', os.path.basename(path), 'from', url)
-    urlretrieve(url, path, reporthook())
-    if not pkg.verify_hash(path):
+    progress.log('Downloading', os.path.basename(path), 'from', url)
+    partial = path + PARTIAL_DOWNLOAD_SUFFIX
+    h = fetch(url, partial, pkg.new_hash, progress)
+    if not pkg.hash_matches(h):
+        actual_hash = sha256_for_path(partial)
+        os.remove(partial)
         raise SystemExit(
             f'The hash of the downloaded file: {os.path.basename(path)}'
             ' does not match the saved hash. It\'s sha256 is'
-            f': {sha256_for_path(path)}')
+            f': {actual_hash}')
+    os.replace(partial, path)
+    verified_files.mark_verified(path, pkg.expected_hash)
+
+
+def mirror_url() -> str:
+    ''' The URL of the source mirror run by bypy mirror on the build host, if any '''
+    return os.environ.get('BYPY_MIRROR', '').rstrip('/')
 
 
-def download_pkg(pkg: Dependency, path: str) -> None:
+def download_from_mirror(pkg: Dependency, path: str, progress: DownloadProgress) -> bool:
+    alg, _, q = pkg.expected_hash.partition(':')
+    if not (mirror := mirror_url()) or alg.lower() != 'sha256':
+        return False
+    url = f'{mirror}/sha256/{q.strip()}'
+    try:
+        try_once(pkg, url, path, progress)
+    except HTTPError as err:
+        if err.code != 404:
+            progress.log(f'Download of {url} failed, with error: {err}', file=sys.stderr)
+        return False
+    except (Exception, SystemExit) as err:
+        progress.log(f'Download of {url} failed, with error: {err}', file=sys.stderr)
+        return False
+    return True
+
+
+def download_pkg(pkg: Dependency, path: str, progress: DownloadProgress | None = None) -> None:
+    import traceback
+    if progress is None:
+        progress = DownloadProgress()
+    if source_store.restore(pkg.expected_hash, path):
+        return
+    if download_from_mirror(pkg, path, progress):
+        source_store.add(path, pkg.expected_hash)
+        return
     for try_count in range(DOWNLOAD_RETRIES):
         for url in pkg.urls:
             try:
-                return try_once(pkg, url, path)
+                try_once(pkg, url, path, progress)
+                source_store.add(path, pkg.expected_hash)
+                return
             except HTTPError as err:
                 if err.code == 404:
                     raise SystemExit(f'Download of {url} failed, with error: {err}') from err
-                import traceback
-                traceback.print_exc()
-                print(f'Download of {url} failed, with error: {err}', flush=True, file=sys.stderr)
+                progress.log(traceback.format_exc(), file=sys.stderr)
+                progress.log(f'Download of {url} failed, with error: {err}', file=sys.stderr)
             except Exception as err:
-                import traceback
-                traceback.print_exc()
-                print(f'Download of {url} failed, with error: {err}', flush=True, file=sys.stderr)
-            finally:
-                print()
+                progress.log(traceback.format_exc(), file=sys.stderr)
+                progress.log(f'Download of {url} failed, with error: {err}', file=sys.stderr)
     raise SystemExit(
         f'Downloading of {pkg.name} failed after {DOWNLOAD_RETRIES} tries, giving up.')
 
 
 def cleanup_cache(all_filename_prefixes: set[str]) -> None:
+    ''' Remove the names of sources that are no longer needed from SOURCES.
+    The sources themselves remain in the store until evicted from it. '''
 
     def matches_prefix(x: str) -> bool:
         for q in all_filename_prefixes:
@@ -602,14 +1326,36 @@ def cleanup_cache(all_filename_prefixes: set[str]) -> None:
         return False
 
     if os.path.exists(SOURCES):
-        for not_needed in (x for x in os.listdir(SOURCES) if not matches_prefix(x)):
+        for not_needed in (x for x in os.listdir(SOURCES) if not matches_prefix(x) and not x.startswith('.')):
             print('Removing obsolete source file:', not_needed)
             os.unlink(os.path.join(SOURCES, not_needed))
+        source_store.evict()
 
 
-def ensure_downloaded() -> None:
-    all_filename_prefixes = set()
-    for pkg in read_deps():
-        pkg.ensure_downloaded()
-        all_filename_prefixes.add(pkg.filename_prefix)
-    cleanup_cache(all_filename_prefixes)
+def ensure_downloaded(deps: tuple[Dependency, ...] | None = None) -> None:
+    ''' Download the specified dependencies, all by default, concurrently. A
+    dependency that fails to download does not stop the others, the failures
+    are reported together at the end. Obsolete files are removed from SOURCES
+    only when downloading all dependencies. '''
+    all_deps = deps is None
+    deps = read_deps() if deps is None else deps
+    progress = DownloadProgress(len(deps))
+    failures = []
+
+    def download(pkg: Dependency) -> None:
+        try:
+            pkg.ensure_downloaded(progress)
+        finally:
+            progress.file_finished()
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix='Download') as executor:
+        futures = [(pkg, executor.submit(download, pkg)) for pkg in deps]
+        for pkg, fut in futures:
+            if (err := fut.exception()) is not None:
+                failures.append(pkg)
+                progress.log(f'Failed to download {pkg.name}: {err}', file=sys.stderr)
+    progress.finish()
+    if failures:
+        raise SystemExit('Failed to download: ' + ', '.join(pkg.name for pkg in failures))
+    if all_deps:
+        cleanup_cache({pkg.filename_prefix for pkg in deps})
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+# A GNU make jobserver shared by every build tool run by bypy, so that the
+# total number of compile jobs is bounded no matter how many dependencies are
+# being built concurrently. See
+# https://www.gnu.org/software/make/manual/html_node/Job-Slots.html
+
+import os
+import re
+import subprocess
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from functools import lru_cache
+
+from .constants import iswindows, mkdtemp
+
+# The first versions that understand --jobserver-auth=fifo:
+MIN_MAKE_VERSION = 4, 4
+
+
+@lru_cache(maxsize=2)
+def make_version() -> tuple[int, ...]:
+    try:
+        raw = subprocess.check_output(['make', '--version']).decode('utf-8', 'replace')
+    except (OSError, subprocess.CalledProcessError):
+        return ()
+    m = re.match(r'GNU Make (\d+)\.(\d+)', raw)
+    return tuple(map(int, m.groups())) if m else ()
+
+
+def jobserver_fifo() -> str:
+    ' The path to the FIFO of the jobserver in use, if any '
+    m = re.search(r'--jobserver-auth=fifo:(\S+)', os.environ.get('MAKEFLAGS', ''))
+    return m.group(1) if m else ''
+
+
+@contextmanager
+def jobserver(jobs: int) -> Iterator[str]:
+    '''
+    Create a jobserver allowing jobs concurrent jobs and export it via
+    MAKEFLAGS to all child processes. Every client can always run one job,
+    for more it must read a token from the FIFO and write it back when the
+    job is done, so the FIFO holds jobs - 1 tokens.
+    '''
+    if iswindows or jobs < 2 or make_version() < MIN_MAKE_VERSION or jobserver_fifo():
+        yield jobserver_fifo()
+        return
+    tdir = mkdtemp('jobserver-')
+    path = os.path.join(tdir, 'fifo')
+    os.mkfifo(path, 0o600)
+    # Keep it open for both reading and writing so that it never reaches EOF
+    fd = os.open(path, os.O_RDWR)
+    orig = os.environ.get('MAKEFLAGS')
+    try:
+        os.write(fd, b'+' * (jobs - 1))
+        os.environ['MAKEFLAGS'] = f'-j{jobs} --jobserver-auth=fifo:{path}'
+        yield path
+    finally:
+        if orig is None:
+            os.environ.pop('MAKEFLAGS', None)
+        else:
+            os.environ['MAKEFLAGS'] = orig
+        os.close(fd)
+        os.remove(path)
+        os.rmdir(tdir)
+
+
+class JobServerClient:
+    ''' Run jobs in threads, taking a token from the jobserver, if any, for
+    every job but one '''
+
+    def __init__(self, path: str = ''):
+        self.path = path or jobserver_fifo()
+        self.fd = os.open(self.path, os.O_RDWR) if self.path else -1
+        self.implicit_slot = threading.Lock()
+
+    def close(self) -> None:
+        if self.fd > -1:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self) -> 'JobServerClient':
+        return self
+
+    def __exit__(self, *a) -> None:
+        self.close()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        if self.fd < 0 or self.implicit_slot.acquire(blocking=False):
+            try:
+                yield
+            finally:
+                if self.fd > -1:
+                    self.implicit_slot.release()
+            return
+        token = os.read(self.fd, 1)
+        try:
+            yield
+        finally:
+            os.write(self.fd, token)
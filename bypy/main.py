@@ -4,6 +4,7 @@
 
 import argparse
 import atexit
+import importlib
 import os
 import runpy
 import shutil
@@ -13,16 +14,32 @@ from contextlib import suppress
 from itertools import chain
 
 from .constants import BYPY, OS_NAME, OUTPUT_DIR, ROOT, SRC, SW, WORKER_DIR, build_dir, in_chroot, islinux, iswindows
-from .deps import init_env
-from .deps import main as deps_main
-from .utils import mkdtemp, rmtree, run_shell, setup_dependencies_parser
 
 SCREEN_NAME = 'bypy-deps-worker'
+# Subcommand name: (module:function that sets up its parser, help, aliases).
+# Only the module of the subcommand being run is imported, which keeps the
+# worker-status probes run over SSH before every VM build fast.
+SUBCOMMANDS: dict[str, tuple[str, str, tuple[str, ...]]] = {
+    'vm': ('virtual_machine.run:setup_parser', 'Control the building and running of Virtual Machines', ()),
+    'linux': ('bypy.linux:setup_parser', 'Build in a Linux VM', ()),
+    'macos': ('bypy.macos:setup_parser', 'Build in a macOS VM', ()),
+    'windows': ('bypy.windows:setup_parser', 'Build in a Windows VM', ('win',)),
+    'export': ('bypy.export:setup_parser', 'Export built deps to a CI server', ()),
+    'worker-status': ('bypy.main:setup_worker_status_parser', 'Check the status of the bypy dependency build worker', ()),
+    'program': ('bypy.main:setup_program_parser', 'Build the program', ()),
+    'dependencies': ('bypy.main:setup_build_deps_parser', 'Build the dependencies', ('deps',)),
+    'shell': ('bypy.main:setup_shell_parser', 'Run a shell with a completely initialized environment', ()),
+    'mirror': ('bypy.mirror:setup_parser', 'Serve the sources cache over HTTP, for use by builds in VMs', ()),
+    'sbom': ('bypy.main:setup_sbom_parser', 'Generate a SBOM which is printed to STDOUT in SPDX JSON format', ()),
+    '__reconnect__': ('bypy.main:setup_reconnect_parser', 'For internal use', ()),
+}
 
 
 def build_program(args):
+    from .deps import init_env
+    from .utils import mkdtemp, rmtree, run_shell
     atexit.register(delete_code_signing_certs)
-    init_env()
+    init_env(overlay=args.overlay_prefix)
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     init_env_module = runpy.run_path(os.path.join(
         SRC, 'bypy', 'init_env.py'),
@@ -135,6 +152,7 @@ def setup_worker_status_parser(p):
 
 
 def setup_build_deps_parser(p):
+    from .utils import setup_dependencies_parser
     setup_dependencies_parser(p)
     p.set_defaults(func=build_deps)
 
@@ -146,6 +164,8 @@ def setup_program_parser(p):
 
 
 def shell(args):
+    from .deps import init_env
+    from .utils import run_shell
     init_env()
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     run_shell(library_path=True, cwd=ROOT)
@@ -172,7 +192,7 @@ def sbom(args):
     import uuid
     from datetime import datetime
 
-    from .download_sources import read_deps, read_go_deps
+    from .download_sources import prefetch_pypi_metadata, read_deps, read_go_deps
     foundry, _, project = args.name.partition('/')
     if not project:
         project = foundry
@@ -217,6 +237,7 @@ def sbom(args):
             }
         ],
     }
+    prefetch_pypi_metadata(read_deps())
     for pkg in chain(read_deps(), read_go_deps()):
         package_spdx = pkg.sbom_spdx
         sbom_document["packages"].append(package_spdx)
@@ -245,6 +266,7 @@ def setup_sbom_parser(p):
 
 
 def build_deps(args):
+    from .deps import main as deps_main
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     os.makedirs(WORKER_DIR, exist_ok=True)
     delete_code_signing_certs()
@@ -263,11 +285,6 @@ def build_deps(args):
 
 
 def global_main(args):
-    from bypy.export import setup_parser as export_setup_parser
-    from bypy.linux import setup_parser as linux_setup_parser
-    from bypy.macos import setup_parser as macos_setup_parser
-    from bypy.windows import setup_parser as windows_setup_parser
-    from virtual_machine.run import setup_parser as vm_setup_parser
     if not iswindows:
         import resource
         soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
@@ -276,16 +293,11 @@ def global_main(args):
 
     p = argparse.ArgumentParser(prog='bypy')
     s = p.add_subparsers(required=True)
-    vm_setup_parser(s.add_parser('vm', help='Control the building and running of Virtual Machines'))
-    linux_setup_parser(s.add_parser('linux', help='Build in a Linux VM'))
-    macos_setup_parser(s.add_parser('macos', help='Build in a macOS VM'))
-    windows_setup_parser(s.add_parser('windows', help='Build in a Windows VM', aliases=['win']))
-    export_setup_parser(s.add_parser('export', help='Export built deps to a CI server'))
-    setup_worker_status_parser(s.add_parser('worker-status', help='Check the status of the bypy dependency build worker'))
-    setup_program_parser(s.add_parser('program', help='Build the program'))
-    setup_build_deps_parser(s.add_parser('dependencies', aliases=['deps'], help='Build the dependencies'))
-    setup_shell_parser(s.add_parser('shell', help='Run a shell with a completely initialized environment'))
-    setup_sbom_parser(s.add_parser('sbom', help='Generate a SBOM which is printed to STDOUT in SPDX JSON format'))
-    setup_reconnect_parser(s.add_parser('__reconnect__', help='For internal use'))
+    chosen = args[1] if len(args) > 1 else ''
+    for name, (setup, help_text, aliases) in SUBCOMMANDS.items():
+        sp = s.add_parser(name, help=help_text, aliases=aliases)
+        if chosen == name or chosen in aliases:
+            module, _, func = setup.partition(':')
+            getattr(importlib.import_module(module), func)(sp)
     parsed_args = p.parse_args(args[1:])
     parsed_args.func(parsed_args)
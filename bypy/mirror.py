@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+# Serve the sources cache over HTTP, addressing files by their sha256 hash.
+# Builds in VMs fetch the sources they need from it on demand, see
+# download_sources.download_from_mirror(), instead of having the whole cache
+# copied to them before every run.
+
+import http.server
+import os
+import re
+import shutil
+import threading
+
+from .constants import base_dir
+from .download_sources import PARTIAL_DOWNLOAD_SUFFIX, SourceStore, VerifiedFiles, sha256_for_path
+
+
+class SourceIndex:
+
+    def __init__(self, sources_dir: str):
+        self.sources_dir = sources_dir
+        self.verified_files = VerifiedFiles(sources_dir)
+        self.source_store = SourceStore(sources_dir)
+        self.lock = threading.Lock()
+        self.path_for_hash: dict[str, str] = {}
+
+    def refresh(self) -> None:
+        ans = {}
+        for x in os.listdir(self.sources_dir):
+            path = os.path.join(self.sources_dir, x)
+            if x.startswith('.') or x.endswith(PARTIAL_DOWNLOAD_SUFFIX) or not os.path.isfile(path):
+                continue
+            alg, _, q = self.verified_files.verified_hash(path).partition(':')
+            if alg.lower() != 'sha256':
+                q = sha256_for_path(path)
+                self.verified_files.mark_verified(path, f'sha256:{q}')
+            self.source_store.add(path, f'sha256:{q}')
+            ans[q] = path
+        self.path_for_hash = ans
+
+    def __call__(self, sha256: str) -> str:
+        # Files in the store are named by their hash
+        if os.path.isfile(path := self.source_store.path_for(f'sha256:{sha256}')):
+            return path
+        with self.lock:
+            path = self.path_for_hash.get(sha256)
+            if not path or not os.path.exists(path):
+                # New files may have been added since the last refresh
+                self.refresh()
+                path = self.path_for_hash.get(sha256, '')
+            return path
+
+
+class MirrorRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    source_index: SourceIndex
+
+    def log_message(self, fmt: str, *args) -> None:
+        pass  # silence access logging
+
+    def do_HEAD(self) -> None:
+        self.send_source(send_body=False)
+
+    def do_GET(self) -> None:
+        self.send_source()
+
+    def send_source(self, send_body: bool = True) -> None:
+        m = re.fullmatch(r'/sha256/([0-9a-fA-F]{64})', self.path)
+        if m is None:
+            self.send_error(404)
+            return
+        path = self.source_index(m.group(1).lower())
+        if not path:
+            self.send_error(404, f'No source with hash: {m.group(1)}')
+            return
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            offset = 0
+            # Partial downloads are resumed by asking for the rest of the file
+            if (rm := re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))) is not None:
+                offset = int(rm.group(1))
+                if offset >= size:
+                    self.send_error(416)
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {offset}-{size - 1}/{size}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(size - offset))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            if send_body:
+                f.seek(offset)
+                shutil.copyfileobj(f, self.wfile)
+
+
+def create_server(sources_dir: str, host: str = 'localhost', port: int = 0) -> http.server.ThreadingHTTPServer:
+    handler = type('Handler', (MirrorRequestHandler,), {'source_index': SourceIndex(os.path.abspath(sources_dir))})
+    httpd = http.server.ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+    return httpd
+
+
+def run_server(sources_dir: str) -> http.server.ThreadingHTTPServer:
+    httpd = create_server(sources_dir)
+    print(f'Source mirror starting on http://{httpd.server_address[0]}:{httpd.server_address[1]}')
+    server_thread = threading.Thread(target=httpd.serve_forever, name='SourceMirror')
+    server_thread.daemon = True
+    server_thread.start()
+    return httpd
+
+
+def main(args) -> None:
+    os.makedirs(args.sources_dir, exist_ok=True)
+    httpd = create_server(args.sources_dir, args.listen, args.port)
+    print(f'Serving {args.sources_dir} on http://{httpd.server_address[0]}:{httpd.server_address[1]}')
+    print(f'Set BYPY_MIRROR=http://{httpd.server_address[0]}:{httpd.server_address[1]} for builds to use it')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        httpd.shutdown()
+
+
+def setup_parser(p) -> None:
+    p.add_argument('sources_dir', nargs='?', default=os.path.join(base_dir(), 'b', 'sources-cache'),
+                   help='The directory containing the sources to serve. Defaults to the sources cache.')
+    p.add_argument('--listen', default='localhost', help='The address to listen on')
+    p.add_argument('--port', default=0, type=int, help='The port to listen on, by default a random free port is used')
+    p.set_defaults(func=main)
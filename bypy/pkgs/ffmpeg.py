@@ -4,10 +4,12 @@
 
 import os
 
-from bypy.constants import BIN, MAKEOPTS, build_dir, current_build_arch, ismacos, iswindows
+from bypy.constants import BIN, build_dir, current_build_arch, ismacos, iswindows, makeopts
 from bypy.utils import run, simple_build
 
 needs_lipo = True
+# The reference outputs of the FATE test suite are only used by make fate
+extract_exclude = ('tests/ref',)
 # See https://code.qt.io/cgit/qt/qt5.git/tree/coin/provisioning/common/shared/ffmpeg_config_options.txt
 common_options = '--disable-programs --disable-doc --disable-debug --enable-network --disable-lzma --enable-pic --disable-vulkan --disable-v4l2-m2m --disable-decoder=truemotion1 --enable-shared --disable-static --enable-gpl'
 
@@ -15,7 +17,7 @@ common_options = '--disable-programs --disable-doc --disable-debug --enable-netw
 if iswindows:
     def main(args):
         run('sh', '-c', f'PATH=/usr/bin:$PATH; ./configure --prefix=installed --toolchain=msvc --arch=x86_64 --enable-asm {common_options}')
-        run('sh', '-c', f'PATH=/usr/bin:$PATH; make {MAKEOPTS}')
+        run('sh', '-c', f'PATH=/usr/bin:$PATH; make {makeopts()}')
         run('sh', '-c', 'PATH=/usr/bin:$PATH; make install')
         os.rename('installed', os.path.join(build_dir(), 'ffmpeg'))
 else:
@@ -7,6 +7,7 @@ import os
 import re
 import shutil
 
+from bypy.checkpoint import run_phase
 from bypy.constants import (
     LIBDIR, PREFIX, build_dir, cygwin_paths, is64bit, islinux, iswindows,
     lipo_data
@@ -60,6 +61,19 @@ def cygwin_build():
         os.remove(dll)
 
 
+def move_installed_files():
+    usr = os.path.join(build_dir(), 'usr')
+    os.rename(os.path.join(usr, 'include'),
+              os.path.join(build_dir(), 'include'))
+    os.rename(os.path.join(usr, 'lib'), os.path.join(build_dir(), 'lib'))
+    for path in walk(build_dir()):
+        if path.endswith('.pc'):
+            replace_in_file(path,
+                            re.compile(br'^prefix\s*=\s*/usr', flags=re.M),
+                            f'prefix={PREFIX}')
+    shutil.rmtree(usr)
+
+
 def main(args):
     os.chdir('source')
 
@@ -77,16 +91,7 @@ def main(args):
 
         simple_build(
             conf, install_args='DESTDIR=' + build_dir(), relocate_pkgconfig=False)
-        usr = os.path.join(build_dir(), 'usr')
-        os.rename(os.path.join(usr, 'include'),
-                  os.path.join(build_dir(), 'include'))
-        os.rename(os.path.join(usr, 'lib'), os.path.join(build_dir(), 'lib'))
-        for path in walk(build_dir()):
-            if path.endswith('.pc'):
-                replace_in_file(path,
-                                re.compile(br'^prefix\s*=\s*/usr', flags=re.M),
-                                f'prefix={PREFIX}')
-        shutil.rmtree(usr)
+        run_phase('move installed files', move_installed_files)
 
         if 'first_build_dir' not in lipo_data:
             lipo_data['first_build_dir'] = build_loc
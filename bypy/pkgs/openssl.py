@@ -6,8 +6,8 @@ import glob
 import os
 import shutil
 
-from bypy.constants import (CFLAGS, LDFLAGS, MAKEOPTS, NMAKE, PERL, build_dir,
-                            is64bit, ismacos, iswindows, current_build_arch)
+from bypy.constants import (CFLAGS, LDFLAGS, NMAKE, PERL, build_dir,
+                            is64bit, ismacos, iswindows, current_build_arch, makeopts)
 from bypy.utils import run
 
 
@@ -20,7 +20,7 @@ def main(args):
         run(
             f'./Configure darwin64-{arch}-cc shared enable-ec_nistp_64_gcc_128'
             f' no-ssl2 --prefix={build_dir()} --openssldir={build_dir()}')
-        run('make ' + MAKEOPTS)
+        run('make ' + makeopts())
         run('make install_sw')
     elif iswindows:
         conf = f'{PERL} Configure VC-WIN32 enable-static-engine'.split()
@@ -48,7 +48,7 @@ def main(args):
         run('./config', '--prefix=/usr', '--libdir=lib',
             '--openssldir=/dev/null', 'shared', 'no-tests', 'zlib', '-Wa,--noexecstack',
             CFLAGS, LDFLAGS, *optflags)
-        run('make ' + MAKEOPTS)
+        run('make ' + makeopts())
         run('make test', library_path=os.getcwd())
         run('make', 'DESTDIR={}'.format(build_dir()), 'install_sw')
         for x in 'bin lib include'.split():
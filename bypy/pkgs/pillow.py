@@ -12,8 +12,7 @@ from bypy.utils import python_build, python_install, replace_in_file
 def patch_for_windows():
     incdir = os.path.join(PREFIX, 'include')
     libdir = os.path.join(PREFIX, 'lib')
-    with open('setup.cfg', 'a') as s:
-        print(f'''
+    replace_in_file('setup.cfg', '', f'''
 [build_ext]
 include_dirs = {incdir}
 library_dirs = {libdir}
@@ -21,7 +20,8 @@ enable_zlib = True
 enable_jpeg = True
 enable_webp = True
 enable_freetype = True
-''', file=s)
+
+''')
 
     replace_in_file('setup.py', 'DEBUG = False', 'DEBUG = True')
     replace_in_file('setup.py', 'for library in ("webp", "webpmux", "webpdemux")', 'for library in ("webp_dll", "webpmux_dll", "webpdemux_dll")')
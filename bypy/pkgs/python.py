@@ -10,6 +10,8 @@ import shutil
 from bypy.constants import CFLAGS, LDFLAGS, LIBDIR, PREFIX, PYTHON, UNIVERSAL_ARCHES, build_dir, is64bit, islinux, ismacos, iswindows
 from bypy.utils import ModifiedEnv, copy_headers, get_platform_toolset, get_windows_sdk, install_binaries, replace_in_file, run, simple_build, walk, run_shell
 run_shell
+# The sphinx sources of the documentation
+extract_exclude = ('Doc',)
 
 
 def unix_python(args):
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import json
+import os
+import select
+import sys
+import time
+from collections.abc import Callable, Iterable, Sequence
+from contextlib import suppress
+from typing import Any
+
+from .constants import build_parallelism, cpu_count, islinux, ismacos, temp_root, used_parallelism
+from .download_sources import Dependency
+from .utils import atomic_write, available_physical_ram, set_title, total_physical_ram
+
+# Used for dependencies that have never been built
+DEFAULT_BUILD_DURATION = 60
+DEFAULT_PEAK_MEMORY = 2 * 1024**3
+# How often the RAM used by running builds is measured, in seconds
+MEMORY_SAMPLE_INTERVAL = 1
+
+
+class Job:
+
+    def __init__(self, dep: Dependency, pid: int, log_path: str = ''):
+        self.dep, self.pid, self.log_path = dep, pid, log_path
+        # Becomes readable when the process exits, -1 if not available
+        self.pidfd = -1
+        self.start_time = time.monotonic()
+        self.cpu_time = self.max_rss = None
+        self.parallelism = 0
+        self.memory_needed = self.current_memory = self.peak_memory = 0
+
+    @property
+    def name(self) -> str:
+        return self.dep.name
+
+
+class BuildHistory:
+    ''' Resource usage of the most recent successful builds of each dependency '''
+
+    max_entries = 5
+
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            with open(path, 'rb') as f:
+                self.data: dict[str, list[dict[str, Any]]] = json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            self.data = {}
+
+    def record(self, name: str, **measurements: Any) -> None:
+        measurements['finished_at'] = time.time()
+        entries = self.data.setdefault(name, [])
+        entries.append(measurements)
+        del entries[:-self.max_entries]
+        atomic_write(self.path, json.dumps(self.data, indent=2, sort_keys=True))
+
+    def latest(self, name: str, key: str, default: Any = None) -> Any:
+        for entry in reversed(self.data.get(name, ())):
+            if (ans := entry.get(key)) is not None:
+                return ans
+        return default
+
+    def duration(self, name: str) -> float:
+        ans = self.latest(name, 'wall_time')
+        if ans is None:
+            known = sorted(x for x in (self.latest(n, 'wall_time') for n in self.data) if x is not None)
+            ans = known[len(known) // 2] if known else DEFAULT_BUILD_DURATION
+        return ans
+
+    def memory_per_job(self, name: str) -> float | None:
+        ' The peak RAM used per parallel job by the most recent measured build '
+        for entry in reversed(self.data.get(name, ())):
+            if entry.get('peak_memory') and entry.get('parallelism'):
+                return entry['peak_memory'] / entry['parallelism']
+            if entry.get('max_rss'):
+                # Where the RAM used by the whole build cannot be measured,
+                # this is the RAM used by its largest process, that is, a job
+                return entry['max_rss']
+        return None
+
+
+def format_duration(seconds: float) -> str:
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    return f'{h}h {m:02d}m' if h else f'{m}m {s:02d}s'
+
+
+def tail(path: str, num_of_lines: int = 50) -> str:
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 256 * 1024))
+            lines = f.read().decode('utf-8', 'replace').splitlines()
+    except OSError:
+        return ''
+    return '\n'.join(lines[-num_of_lines:])
+
+
+def process_tree_memory(roots: Iterable[int]) -> dict[int, int]:
+    ''' The resident memory used by each of the specified processes and all
+    their descendants, read from /proc '''
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    children: dict[int, list[int]] = {}
+    rss: dict[int, int] = {}
+    for x in os.listdir('/proc'):
+        if not x.isdigit():
+            continue
+        try:
+            with open(f'/proc/{x}/stat', 'rb') as f:
+                raw = f.read()
+        except OSError:
+            continue  # the process has exited
+        # The command name can contain spaces and parentheses
+        fields = raw[raw.rfind(b')') + 2:].split()
+        pid = int(x)
+        children.setdefault(int(fields[1]), []).append(pid)
+        rss[pid] = int(fields[21]) * page_size
+    ans = {}
+    for root in roots:
+        total, stack = 0, [root]
+        while stack:
+            pid = stack.pop()
+            total += rss.get(pid, 0)
+            stack.extend(children.get(pid, ()))
+        ans[root] = total
+    return ans
+
+
+def run_in_child(func: Callable[[], None], log_path: str = '') -> int:
+    sys.stdout.flush(), sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        return pid
+    rc = 1
+    try:
+        if log_path:
+            fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.dup2(fd, sys.stdout.fileno()), os.dup2(fd, sys.stderr.fileno())
+            os.close(fd)
+        func()
+        rc = 0
+    except SystemExit as e:
+        rc = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush(), sys.stderr.flush()
+        os._exit(rc)
+
+
+class Scheduler:
+    '''
+    Build a set of dependencies respecting the order imposed by their inputs,
+    running up to jobs builds at a time, each in its own process, or one at
+    a time in this process when jobs is one. Builds are
+    only started, and their parallelism is limited, such that the peak RAM
+    they used when previously built fits in ram_budget.
+    '''
+
+    def __init__(
+        self, deps: Sequence[Dependency], inputs: dict[str, Iterable[str]], jobs: int = 1, log_dir: str = '',
+        history: BuildHistory | None = None, ram_budget: int = 0,
+    ):
+        self.deps = {d.name: d for d in deps}
+        self.waiting_on = {name: set(inputs.get(name, ())) & set(self.deps) - {name} for name in self.deps}
+        self.jobs = max(1, jobs)
+        self.log_dir = log_dir if self.jobs > 1 else ''
+        self.history = history
+        self.running: dict[int, Job] = {}
+        self.started: set[str] = set()
+        self.built: list[str] = []
+        self.failed: list[Job] = []
+        self.priority = self.critical_paths()
+        self.ram_budget = ram_budget or int(0.85 * total_physical_ram())
+        self.max_parallelism = cpu_count() or 1
+
+    def duration(self, name: str) -> float:
+        return DEFAULT_BUILD_DURATION if self.history is None else self.history.duration(name)
+
+    def critical_paths(self) -> dict[str, float]:
+        ''' The estimated time from starting the build of each dependency to
+        finishing the builds of everything that transitively needs it '''
+        dependents: dict[str, list[str]] = {name: [] for name in self.deps}
+        for name, inputs in self.waiting_on.items():
+            for x in inputs:
+                dependents[x].append(name)
+        ans: dict[str, float] = {}
+
+        def get(name: str, seen: frozenset[str] = frozenset()) -> float:
+            if (q := ans.get(name)) is None:
+                if name in seen:  # a cycle, reported when building
+                    return 0
+                seen |= {name}
+                q = ans[name] = self.duration(name) + max((get(x, seen) for x in dependents[name]), default=0)
+            return q
+        for name in self.deps:
+            get(name)
+        return ans
+
+    @property
+    def pending(self) -> tuple[str, ...]:
+        return tuple(name for name in self.deps if name not in self.started)
+
+    def ready(self) -> Iterable[str]:
+        # Longest remaining path first, so that the build finishes as early
+        # as possible
+        return sorted((name for name in self.pending if not self.waiting_on[name]), key=lambda n: -self.priority[n])
+
+    def plan(self) -> list[tuple[str, float, float]]:
+        ''' Simulate the build using the recorded durations, returning the
+        estimated start and finish times of every dependency '''
+        waiting_on = {k: set(v) for k, v in self.waiting_on.items()}
+        started: set[str] = set()
+        running: list[tuple[float, str]] = []
+        ans, now = [], 0.
+        while True:
+            for name in sorted(
+                    (n for n in self.deps if n not in started and not waiting_on[n]), key=lambda n: -self.priority[n]):
+                if len(running) >= self.jobs:
+                    break
+                started.add(name)
+                running.append((now + self.duration(name), name))
+                ans.append((name, now, running[-1][0]))
+            if not running:
+                break
+            running.sort()
+            now, done = running.pop(0)
+            for w in waiting_on.values():
+                w.discard(done)
+        return ans
+
+    def print_plan(self, verbose: bool = True) -> None:
+        plan = self.plan()
+        total = max((finish for name, start, finish in plan), default=0)
+        if verbose:
+            print(f'{"Start":>9} {"Duration":>9}  Dependency')
+            for name, start, finish in plan:
+                known = self.history is not None and self.history.latest(name, 'wall_time') is not None
+                print(f'{format_duration(start):>9} {format_duration(finish - start):>9}{"" if known else "?"}  {name}')
+            print('Durations marked with ? are guesses as the dependency has never been built')
+        print(f'Estimated to finish in {format_duration(total)} at', time.strftime('%H:%M', time.localtime(time.time() + total)), flush=True)
+
+    def memory_per_job(self, name: str) -> float | None:
+        return None if self.history is None else self.history.memory_per_job(name)
+
+    def memory_needed(self, name: str, parallelism: int = 0) -> float:
+        per_job = self.memory_per_job(name)
+        return DEFAULT_PEAK_MEMORY if per_job is None else per_job * (parallelism or self.max_parallelism)
+
+    def free_memory(self) -> float:
+        ' The RAM available for starting new builds '
+        ans = self.ram_budget - sum(max(j.memory_needed, j.current_memory) for j in self.running.values())
+        if (available := available_physical_ram()) is not None:
+            # Running builds will grow till they reach their expected peak and
+            # there may be other things running on this machine
+            growth = sum(max(0, j.memory_needed - j.current_memory) for j in self.running.values())
+            ans = min(ans, available - growth)
+        return ans
+
+    def admit(self, name: str, free_memory: float) -> int | None:
+        '''
+        The parallelism to build name with, 0 meaning the default of the build
+        tool, or None if there is not enough free RAM to start it now. When
+        nothing else is running the build is always started, with the least
+        parallelism if needed.
+        '''
+        per_job = self.memory_per_job(name)
+        if per_job is None:
+            return 0 if free_memory >= DEFAULT_PEAK_MEMORY or not self.running else None
+        ans = min(self.max_parallelism, int(free_memory // per_job))
+        if ans < 1:
+            return None if self.running else 1
+        # Unlimited builds share the jobserver, if any
+        return ans if ans < self.max_parallelism else 0
+
+    def sample_memory(self) -> None:
+        for pid, used in process_tree_memory(self.running).items():
+            job = self.running[pid]
+            job.current_memory = used
+            job.peak_memory = max(job.peak_memory, used)
+
+    def set_title(self) -> None:
+        names = ', '.join(j.name for j in self.running.values())
+        set_title(f'Building {names} -- {len(self.built) + len(self.running)} of {len(self.deps)}')
+
+    def start(self, name: str, build: Callable[[Dependency], None], parallelism: int = 0) -> Job:
+        dep = self.deps[name]
+        self.started.add(name)
+        log_path = ''
+        if self.log_dir:
+            log_path = os.path.join(self.log_dir, f'{name}.log')
+            print(f'Started building {name}, output is in {log_path}', flush=True)
+        if parallelism and parallelism < self.max_parallelism:
+            print(f'Limiting {name} to {parallelism} parallel jobs to fit in the RAM budget', flush=True)
+
+        def run_build() -> None:
+            build_parallelism(parallelism)
+            used_parallelism(reset=True)
+            try:
+                build(dep)
+            finally:
+                # Recipes can limit their parallelism further, record what
+                # they actually used, for the parent process
+                with open(self.used_parallelism_path(name), 'w') as f:
+                    f.write(str(used_parallelism()))
+
+        if self.jobs > 1 and hasattr(os, 'fork'):
+            pid = run_in_child(run_build, log_path)
+        else:
+            # Serial builds, and all builds on Windows which has no fork, run
+            # in this process
+            pid = -len(self.started)
+        job = self.running[pid] = Job(dep, pid, log_path)
+        if pid > 0 and hasattr(os, 'pidfd_open'):
+            with suppress(OSError):
+                job.pidfd = os.pidfd_open(pid)
+        job.parallelism, job.memory_needed = parallelism, self.memory_needed(name, parallelism)
+        self.set_title()
+        if pid < 0:
+            try:
+                run_build()
+            except BaseException:
+                self.running.pop(pid)
+                self.failed.append(job)
+                raise
+            finally:
+                build_parallelism(0)
+            self.finished(job, 0)
+        return job
+
+    def used_parallelism_path(self, name: str) -> str:
+        return os.path.join(temp_root(), f'{name}.parallelism')
+
+    def used_parallelism(self, job: Job) -> int:
+        try:
+            with open(self.used_parallelism_path(job.name)) as f:
+                ans = int(f.read())
+        except (OSError, ValueError):
+            ans = 0
+        # Builds that do not record their parallelism run serially
+        return ans or job.parallelism or 1
+
+    def finished(self, job: Job, rc: int) -> None:
+        self.running.pop(job.pid, None)
+        if job.pidfd > -1:
+            os.close(job.pidfd)
+            job.pidfd = -1
+        if rc == 0:
+            self.built.append(job.name)
+            if self.history is not None:
+                self.history.record(
+                    job.name, wall_time=time.monotonic() - job.start_time, cpu_time=job.cpu_time, max_rss=job.max_rss,
+                    jobs=self.jobs, peak_memory=job.peak_memory or None, parallelism=self.used_parallelism(job))
+            for w in self.waiting_on.values():
+                w.discard(job.name)
+            print(f'\x1b[36m{job.name} successfully built!\x1b[m', flush=True)
+        else:
+            self.failed.append(job)
+            print(f'\x1b[31mBuilding {job.name} failed\x1b[m', file=sys.stderr, flush=True)
+            if job.log_path:
+                print(tail(job.log_path), file=sys.stderr)
+                print(f'\nThe full build log is in {job.log_path}', file=sys.stderr, flush=True)
+                if self.running:
+                    print('Waiting for running builds to finish:', ', '.join(j.name for j in self.running.values()), flush=True)
+        remaining = tuple(name for name in self.deps if name not in self.built)
+        if remaining:
+            print('Remaining deps:', ', '.join(remaining), flush=True)
+
+    def wait_for_one(self) -> None:
+        # On Linux measure the RAM used by the running builds till one of
+        # them exits
+        pidfds = [j.pidfd for j in self.running.values()]
+        if islinux and pidfds and min(pidfds) > -1:
+            while True:
+                self.sample_memory()
+                if select.select(pidfds, [], [], MEMORY_SAMPLE_INTERVAL)[0]:
+                    break
+        try:
+            pid, status, rusage = os.wait4(-1, 0)
+        except ChildProcessError:
+            for job in tuple(self.running.values()):
+                self.finished(job, 1)
+            return
+        if (job := self.running.get(pid)) is not None:
+            # Includes the usage of all processes the build waited for
+            job.cpu_time = rusage.ru_utime + rusage.ru_stime
+            job.max_rss = rusage.ru_maxrss * (1 if ismacos else 1024)
+            self.finished(job, os.waitstatus_to_exitcode(status))
+
+    def __call__(self, build: Callable[[Dependency], None]) -> None:
+        if self.log_dir:
+            os.makedirs(self.log_dir, exist_ok=True)
+        # Builds create their temp dirs concurrently, so initialize the
+        # temp root before any worker is started
+        temp_root()
+        while True:
+            started = False
+            if not self.failed:
+                free_memory = self.free_memory()
+                reserved = False
+                for name in tuple(self.ready()):
+                    if len(self.running) >= self.jobs:
+                        break
+                    if (parallelism := self.admit(name, free_memory)) is None:
+                        if not reserved:
+                            # Keep the RAM needed by the most important waiting
+                            # build free for it, builds needing less RAM can use
+                            # whatever is left
+                            reserved = True
+                            free_memory -= min(self.memory_needed(name), self.ram_budget)
+                        continue
+                    free_memory -= self.start(name, build, parallelism).memory_needed
+                    started = True
+            if self.running:
+                self.wait_for_one()
+            elif not started:
+                break
+        if self.failed:
+            raise SystemExit(1)
+        if pending := self.pending:
+            raise SystemExit('There is a cycle in the inputs of the dependencies: ' + ', '.join(pending))
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+# Pristine extracted source trees are cached in SOURCE_TREES_DIR, named by the
+# hash of the source they were extracted from, so that rebuilding a dependency
+# does not have to decompress its source again. Builds work on a checkout of
+# the cached tree whose files are cloned (copy-on-write) where the filesystem
+# supports it, and copied otherwise. Patches are applied by the recipes to the
+# checkout, since they are interleaved with the other steps of the build.
+
+import errno
+import hashlib
+import os
+import shutil
+from contextlib import suppress
+from typing import Callable, Iterable
+
+from .constants import SOURCE_TREES_DIR, islinux, ismacos
+
+# Increase when the layout of extracted trees changes, to invalidate the cache
+SOURCE_TREE_FORMAT = 1
+SOURCE_TREES_MAX = 16
+FICLONE = 0x40049409
+COPY_RANGE_CHUNK = 64 * 1024 * 1024
+CLONE_NOFOLLOW = 1
+UNSUPPORTED_ERRNOS = frozenset({errno.EOPNOTSUPP, errno.ENOTSUP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS})
+
+
+def source_trees_max() -> int:
+    ' The number of trees to keep in the cache, 0 disables it '
+    return int(os.environ.get('BYPY_SOURCE_TREES_MAX', SOURCE_TREES_MAX))
+
+
+def checkout_method() -> str:
+    '''
+    One of auto, copy or hardlink. auto clones files where the filesystem
+    supports it and copies them otherwise. hardlink creates a hard link farm
+    instead of copying, which is fast on any filesystem but is only safe when
+    nothing in the build modifies files in place. replace_in_file() breaks the
+    links of the files it changes, but build tools and recipes that write to
+    files directly end up modifying the cached tree.
+    '''
+    ans = os.environ.get('BYPY_SOURCE_TREE_CHECKOUT', 'auto')
+    return ans if ans in ('copy', 'hardlink') else 'auto'
+
+
+def tree_key(source_hash: str, exclude: Iterable[str] = (), patches: str = '') -> str:
+    ''' The name of the cached tree of a source. Trees extracted with
+    different exclude globs, or for recipes that use different patches,
+    identified by the hash of their patches, are cached separately. '''
+    alg, _, q = source_hash.partition(':')
+    parts = [alg.lower(), q.strip(), f'v{SOURCE_TREE_FORMAT}']
+    if exclude or patches:
+        h = hashlib.sha256('\0'.join(sorted(exclude)).encode())
+        h.update(b'\0' + patches.encode())
+        parts.append(h.hexdigest()[:16])
+    return '-'.join(parts)
+
+
+def clone_file(src: str, dst: str) -> bool:
+    ''' Create dst sharing the data of src, returns False if the filesystem does
+    not support it '''
+    import fcntl
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError as e:
+            if e.errno in UNSUPPORTED_ERRNOS:
+                return False
+            raise
+    shutil.copystat(src, dst)
+    return True
+
+
+def copy_file_range(src: str, dst: str) -> bool:
+    ''' Copy src to dst in the kernel, filesystems that support it share the
+    data, returns False if the files are on filesystems that do not '''
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            while os.copy_file_range(s.fileno(), d.fileno(), COPY_RANGE_CHUNK):
+                pass
+        except OSError as e:
+            if e.errno in UNSUPPORTED_ERRNOS:
+                return False
+            raise
+    shutil.copystat(src, dst)
+    return True
+
+
+def clone_entry(src: str, dst: str) -> bool:
+    ' Clone src, which can be a directory, to dst using clonefile() on macOS '
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.clonefile(os.fsencode(src), os.fsencode(dst), CLONE_NOFOLLOW) == 0:
+        return True
+    if (err := ctypes.get_errno()) in UNSUPPORTED_ERRNOS:
+        return False
+    raise OSError(err, os.strerror(err), src)
+
+
+class FileCopier:
+    ''' Copies files using the cheapest mechanism the filesystems support,
+    clones, then copies in the kernel and finally plain copies. Once a
+    mechanism fails it is not tried again, so use an instance per source and
+    destination pair. Safe to use from multiple threads. '''
+
+    def __init__(self, method: str = 'auto'):
+        self.method = method
+        self.clone = method == 'auto' and (islinux or ismacos)
+        self.copy_range = method == 'auto' and islinux
+
+    def copy_file(self, src: str, dst: str) -> None:
+        if self.clone:
+            if (clone_entry if ismacos else clone_file)(src, dst):
+                return
+            self.clone = False
+        if self.copy_range:
+            if copy_file_range(src, dst):
+                return
+            self.copy_range = False
+        if self.method == 'hardlink':
+            os.link(src, dst)
+        else:
+            shutil.copy2(src, dst)
+
+    def copy_entry(self, entry: os.DirEntry, dst: str) -> None:
+        if entry.is_symlink():
+            os.symlink(os.readlink(entry.path), dst)
+        elif entry.is_dir():
+            os.mkdir(dst)
+            self.copy_tree(entry.path, dst)
+            shutil.copystat(entry.path, dst)
+        else:
+            self.copy_file(entry.path, dst)
+
+    def copy_tree(self, src: str, dst: str) -> None:
+        for entry in os.scandir(src):
+            self.copy_entry(entry, os.path.join(dst, entry.name))
+
+    def __call__(self, src: str, dst: str) -> None:
+        for entry in os.scandir(src):
+            d = os.path.join(dst, entry.name)
+            if self.clone and ismacos:
+                # clonefile() clones whole directory trees in a single call
+                if clone_entry(entry.path, d):
+                    continue
+                self.clone = False
+            self.copy_entry(entry, d)
+
+
+def break_hardlink(path: str) -> None:
+    ' Replace path with a copy of itself if it is hard linked, so it can be modified without changing the other links '
+    if os.lstat(path).st_nlink > 1:
+        tmp = path + '.bypy-unlink'
+        shutil.copy2(path, tmp)
+        os.replace(tmp, path)
+
+
+def evict_source_trees(keep: int) -> None:
+    ' Remove the least recently used trees beyond the first keep '
+    with suppress(FileNotFoundError):
+        trees = sorted(
+            (e.stat().st_mtime, e.path) for e in os.scandir(SOURCE_TREES_DIR) if e.is_dir() and not e.name.startswith('.'))
+        for _, path in trees[:max(0, len(trees) - keep)]:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def checkout_source_tree(key: str, dest: str, populate: Callable[[str], None]) -> bool:
+    '''
+    Check out the cached tree named key into the existing, empty directory
+    dest. If it is not cached, populate() is called to extract it into a
+    directory first. Returns False if the cache is disabled, in which case the
+    caller has to extract the source itself.
+    '''
+    if (keep := source_trees_max()) < 1:
+        return False
+    tree = os.path.join(SOURCE_TREES_DIR, key)
+    if os.path.isdir(tree):
+        print('Using cached source tree:', key)
+    else:
+        os.makedirs(SOURCE_TREES_DIR, exist_ok=True)
+        tmp = os.path.join(SOURCE_TREES_DIR, f'.{key}-{os.getpid()}')
+        with suppress(FileNotFoundError):
+            shutil.rmtree(tmp)
+        os.mkdir(tmp)
+        try:
+            populate(tmp)
+            try:
+                os.rename(tmp, tree)
+            except OSError:
+                # Populated concurrently by another build of the same source
+                if not os.path.isdir(tree):
+                    raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+    # The modification time of a tree is when it was last used
+    os.utime(tree)
+    evict_source_trees(keep)
+    FileCopier(checkout_method())(tree, dest)
+    return True
@@ -6,7 +6,11 @@
 import atexit
 import ctypes
 import errno
+import filecmp
+import fnmatch
 import glob
+import hashlib
+import json
 import os
 import re
 import shlex
@@ -28,7 +32,6 @@ from .constants import (
     BIN,
     CMAKE,
     LIBDIR,
-    MAKEOPTS,
     MESON,
     NINJA,
     NMAKE,
@@ -40,16 +43,24 @@ from .constants import (
     SH,
     UNIVERSAL_ARCHES,
     build_dir,
+    build_parallelism,
+    cpu_count,
     current_build_arch,
     is64bit,
     is_cross_half_of_lipo_build,
     islinux,
     ismacos,
     iswindows,
+    makeopts,
     mkdtemp,
     python_major_minor_version,
+    used_parallelism,
     worker_env,
 )
+from .checkpoint import phase_completed, should_skip_phase
+from .compiler_cache import compiler_cache_env
+from .jobserver import JobServerClient, jobserver_fifo
+from .source_trees import FileCopier, break_hardlink, checkout_source_tree, tree_key
 
 if iswindows:
     from ctypes import wintypes
@@ -291,7 +302,7 @@ def safe_link(src, dst):
         shutil.copy(src, dst)
 
 
-def lcopy(src, dst, no_hardlinks=False):
+def lcopy(src, dst, no_hardlinks=False, copy_file=shutil.copy):
     try:
         if os.path.islink(src):
             linkto = os.readlink(src)
@@ -299,13 +310,13 @@ def lcopy(src, dst, no_hardlinks=False):
             return True
         else:
             if no_hardlinks:
-                shutil.copy(src, dst)
+                copy_file(src, dst)
             else:
                 safe_link(src, dst)
             return False
     except FileExistsError:
         os.unlink(dst)
-        return lcopy(src, dst)
+        return lcopy(src, dst, no_hardlinks, copy_file)
 
 
 def ensure_clear_dir(path):
@@ -314,7 +325,12 @@ def ensure_clear_dir(path):
     os.makedirs(path)
 
 
-def install_package(pkg_path, dest_dir):
+def package_contents(pkg_path):
+    ' The dirs and files in a package relative to it, symlinks to dirs count as files '
+    if (manifest := read_package_manifest(pkg_path)) is not None:
+        dirs = [e[0] for e in manifest if e[1] == 'd']
+        return dirs, [e[0] for e in manifest if e[1] != 'd']
+    dirs, files = [], []
     for dirpath, dirnames, filenames in os.walk(pkg_path):
         for x in tuple(dirnames):
             d = os.path.join(dirpath, x)
@@ -322,43 +338,147 @@ def install_package(pkg_path, dest_dir):
                 filenames.append(x)
                 dirnames.remove(x)
                 continue
-            name = os.path.relpath(d, pkg_path)
-            os.makedirs(os.path.join(dest_dir, name), exist_ok=True)
+            dirs.append(os.path.relpath(d, pkg_path))
         for x in filenames:
-            f = os.path.join(dirpath, x)
-            name = os.path.relpath(f, pkg_path)
-            lcopy(f, os.path.join(dest_dir, name))
+            files.append(os.path.relpath(os.path.join(dirpath, x), pkg_path))
+    return dirs, files
+
+
+def install_package(pkg_path, dest_dir):
+    dirs, files = package_contents(pkg_path)
+    for name in dirs:
+        os.makedirs(os.path.join(dest_dir, name), exist_ok=True)
+    for name in files:
+        lcopy(os.path.join(pkg_path, name), os.path.join(dest_dir, name))
+
+
+# Decompressors that use multiple threads, or at least run concurrently with
+# the extraction, tried in order for tarballs with the matching suffixes
+PARALLEL_DECOMPRESSORS = {
+    ('.tar.xz', '.txz'): (('xz', '-T0', '-dc'),),
+    ('.tar.gz', '.tgz'): (('pigz', '-dc'),),
+    ('.tar.bz2', '.tbz2', '.tbz'): (('pbzip2', '-dc'), ('lbzip2', '-dc')),
+    ('.tar.zst', '.tar.zstd', '.tzst'): (('zstd', '-T0', '-dc'),),
+}
+
+
+def parallel_decompressor(source):
+    if iswindows:
+        return None
+    q = source.lower()
+    for suffixes, cmds in PARALLEL_DECOMPRESSORS.items():
+        if q.endswith(suffixes):
+            for cmd in cmds:
+                if exe := shutil.which(cmd[0]):
+                    return [exe] + list(cmd[1:])
+    return None
+
+
+def path_matcher(globs):
+    ''' Return a function that is True for paths matching any of globs or
+    inside a directory that does. * in the globs also matches /. '''
+    pats = (g.rstrip('/') for g in globs)
+    pat = re.compile('|'.join(fnmatch.translate(x) for g in pats for x in (g, g + '/*')))
+    return lambda path: pat.match(path) is not None
+
+
+def excluded_member(exclude, name):
+    # Globs are relative to the source tree, which is usually the single top
+    # level directory in the archive
+    name = name.removeprefix('./')
+    return exclude(name) or exclude(name.partition('/')[2])
+
+
+def stream_extract(tf, path='.', exclude=None):
+    ''' Extract the members of the tarfile tf as they are read, in a single
+    pass over the archive, so that it is decompressed only once. The data
+    filter refuses members that would end up outside path. Members for which
+    exclude() is True are never written. Returns the hard links to excluded
+    members, which have to be extracted with extract_link_targets() in a
+    second pass, since the data of their targets has been skipped. '''
+    directories = []
+    links = {}
+    while (member := tf.next()) is not None:
+        # tarfile keeps every member it reads, which for huge archives uses a
+        # lot of memory and is not needed once the member is extracted
+        tf.members.clear()
+        if exclude is not None and excluded_member(exclude, member.name):
+            continue
+        if member.islnk() and exclude is not None and excluded_member(exclude, member.linkname):
+            links.setdefault(member.linkname, []).append(tarfile.data_filter(member, path))
+            continue
+        member = tarfile.data_filter(member, path)
+        if member.isdir():
+            # Extracting their contents changes the mtime of directories
+            directories.append((member.name, member.mtime))
+        tf.extract(member, path, set_attrs=not member.isdir(), filter='fully_trusted')
+    for name, mtime in sorted(directories, reverse=True):
+        with suppress(OSError):
+            os.utime(os.path.join(path, name), (mtime, mtime))
+    return links
+
+
+def extract_link_targets(tf, path, links):
+    ''' Write the data of the excluded members that the hard links returned
+    by stream_extract() point to, as regular files in place of the links '''
+    while (member := tf.next()) is not None:
+        tf.members.clear()
+        if not (dests := links.get(member.name)):
+            continue
+        if not member.isreg():
+            raise tarfile.ExtractError(f'The hard link {dests[0].name} points to {member.name} which is not a regular file')
+        first = dests[0].name
+        tf.extract(tarfile.data_filter(member.replace(name=first, deep=False), path), path, filter='fully_trusted')
+        for link in dests[1:]:
+            os.link(os.path.join(path, first), os.path.join(path, link.name))
+        del links[member.name]
+    if links:
+        names = ', '.join(x.name for v in links.values() for x in v)
+        raise tarfile.ExtractError(f'The targets of the hard links {names} are not in the archive')
+
+
+def read_via_decompressor(cmd, source, callback):
+    with open(source, 'rb') as f:
+        p = subprocess.Popen(cmd, stdin=f, stdout=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=p.stdout, mode='r|', encoding='utf-8') as tf:
+            ans = callback(tf)
+        # tarfile stops reading at the end of archive marker, read the padding
+        # after it, otherwise the decompressor is killed by SIGPIPE
+        with open(os.devnull, 'wb') as devnull:
+            shutil.copyfileobj(p.stdout, devnull)
+    finally:
+        p.stdout.close()
+        rc = p.wait()
+    if rc != 0:
+        raise subprocess.CalledProcessError(rc, cmd)
+    return ans
+
+
+def extract_via_decompressor(cmd, source, path, exclude=None):
+    if links := read_via_decompressor(cmd, source, partial(stream_extract, path=path, exclude=exclude)):
+        read_via_decompressor(cmd, source, partial(extract_link_targets, path=path, links=links))
 
 
-def extract(source, path='.'):
+def extract(source, path='.', exclude=None):
     q = source.lower()
     if q.endswith('.zip'):
         with zipfile.ZipFile(source) as zf:
-            zf.extractall(path)
+            members = None
+            if exclude is not None:
+                members = [n for n in zf.namelist() if not excluded_member(exclude, n)]
+            zf.extractall(path, members)
     elif q.endswith('.whl'):
         shutil.copy2(source, os.path.join(path, os.path.basename(source)))
         os.symlink(os.path.basename(source), 'wheel')
+    elif cmd := parallel_decompressor(source):
+        extract_via_decompressor(cmd, source, path, exclude)
     else:
         with tarfile.open(source, encoding='utf-8') as tf:
-            def is_within_directory(directory, target):
-
-                abs_directory = os.path.abspath(directory)
-                abs_target = os.path.abspath(target)
-
-                prefix = os.path.commonprefix([abs_directory, abs_target])
-
-                return prefix == abs_directory
-
-            def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-
-                for member in tar.getmembers():
-                    member_path = os.path.join(path, member.name)
-                    if not is_within_directory(path, member_path):
-                        raise Exception("Attempted Path Traversal in Tar File")
-
-                tar.extractall(path, members, numeric_owner=numeric_owner)
-
-            safe_extract(tf, path)
+            links = stream_extract(tf, path, exclude)
+        if links:
+            with tarfile.open(source, encoding='utf-8') as tf:
+                extract_link_targets(tf, path, links)
 
 
 def chdir_for_extract(name):
@@ -367,17 +487,34 @@ def chdir_for_extract(name):
     return tdir
 
 
-def extract_source_and_chdir(source):
-    tdir = chdir_for_extract(source)
+def extract_and_flatten(source, path='.', exclude=None):
+    with current_dir(path):
+        extract(source, exclude=exclude)
+        x = os.listdir('.')
+        if len(x) == 1:
+            for y in os.listdir(x[0]):
+                os.rename(os.path.join(x[0], y), y)
+            os.rmdir(x[0])
+
+
+def extract_source_and_chdir(source, tdir='', source_hash='', exclude=(), patches=''):
+    ''' Extract source into tdir, or a new temporary directory, and change
+    to it. Files matching the globs in exclude, relative to the source tree,
+    are not extracted. patches is the hash of the patches the recipe applies,
+    the extracted tree is only shared between builds using the same ones. '''
+    if tdir:
+        ensure_clear_dir(tdir)
+        os.chdir(tdir)
+    else:
+        tdir = chdir_for_extract(source)
     st = time.monotonic()
     print('Extracting source:', source)
     sys.stdout.flush()
-    extract(source)
-    x = os.listdir('.')
-    if len(x) == 1:
-        for y in os.listdir(x[0]):
-            os.rename(os.path.join(x[0], y), y)
-        os.rmdir(x[0])
+    matcher = path_matcher(exclude) if exclude else None
+    key = tree_key(source_hash, exclude, patches)
+    # Sources without a hash, such as local files, are not cached
+    if not source_hash or not checkout_source_tree(key, tdir, partial(extract_and_flatten, source, exclude=matcher)):
+        extract_and_flatten(source, exclude=matcher)
     print('Extracted in', int(time.monotonic() - st), 'seconds')
     return tdir
 
@@ -426,36 +563,43 @@ def simple_build(
         make_args = split(make_args)
     if isinstance(install_args, str):
         install_args = split(install_args)
-    if configure_name and not os.path.exists(configure_name) and os.path.exists(autogen_name):
-        run(autogen_name)
-    env = env or {}
+    env = compiler_cache_env(env or {})
     configure_args += setup_env_for_lipo(env, use_envvars_for_lipo)
-    if configure_name:
-        run(configure_name, '--prefix=' + (
-            override_prefix or build_dir()), *configure_args, env=env, prepend_to_path=prepend_to_path)
-    make_opts = [] if no_parallel else split(MAKEOPTS)
-    run('make', *(make_opts + list(make_args)))
-    if do_install:
+    if not should_skip_phase('configure'):
+        if configure_name and not os.path.exists(configure_name) and os.path.exists(autogen_name):
+            run(autogen_name)
+        if configure_name:
+            run(configure_name, '--prefix=' + (
+                override_prefix or build_dir()), *configure_args, env=env, prepend_to_path=prepend_to_path)
+        phase_completed()
+    if not should_skip_phase('build'):
+        make_opts = [] if no_parallel else split(makeopts())
+        run('make', *(make_opts + list(make_args)))
+        phase_completed()
+    if do_install and not should_skip_phase('install'):
         mi = ['make'] + list(install_args) + ['install']
         run(*mi, library_path=library_path)
         if relocate_pkgconfig:
             relocate_pkgconfig_files()
+        phase_completed()
 
 
 def qt_build(configure_args='', for_webengine=False, dep_name='', **env):
     # To get configure args run qt-configure-module . -help in the module
     # source dir
-    os.mkdir('build')
+    os.makedirs('build', exist_ok=True)
     os.chdir('build')
     append_to_path = [os.path.join(PREFIX, 'qt', 'bin'), BIN]
     prepend_to_path = []
     qcm = os.path.join(PREFIX, 'qt', 'bin', 'qt-configure-module')
     if iswindows:
         qcm += '.bat'
-    run(qcm, '..', '-help',
-        append_to_path=append_to_path, library_path=True)
-    run(qcm, '..', '-list-features',
-        append_to_path=append_to_path, library_path=True)
+    configure = not should_skip_phase('configure')
+    if configure:
+        run(qcm, '..', '-help',
+            append_to_path=append_to_path, library_path=True)
+        run(qcm, '..', '-list-features',
+            append_to_path=append_to_path, library_path=True)
     if iswindows:
         prepend_to_path.append(os.path.dirname(PERL))
         env['CMAKE_PREFIX_PATH'] = PREFIX
@@ -468,26 +612,40 @@ def qt_build(configure_args='', for_webengine=False, dep_name='', **env):
         pass  # configure_args += ' -no-feature-webengine-jumbo-build'
     if dep_name == 'qt-multimedia':
         configure_args += f' -- -DFFMPEG_DIR={PREFIX.replace(os.sep, "/")}/ffmpeg'
-    run(
-        qcm, '..', *shlex.split(configure_args.strip()),
-        library_path=True, append_to_path=append_to_path or None,
-        env=env, prepend_to_path=prepend_to_path or None,
-    )
-    cmd = [CMAKE, '--build', '.', '--parallel']
-    if for_webengine:
-        # ninja by default creates cpu_count + 2 jobs, max RAM per job is thus
-        # RAM/num_jobs. Linking webengine requires several GB of RAM -- ka blammo
+    if configure:
+        run(
+            qcm, '..', *shlex.split(configure_args.strip()),
+            library_path=True, append_to_path=append_to_path or None,
+            env=env, prepend_to_path=prepend_to_path or None,
+        )
+    cmd = [CMAKE, '--build', '.']
+    if build_parallelism():
+        cmd += ['--parallel', str(build_parallelism())]
+    elif not jobserver_fifo():
+        cmd.append('--parallel')
+    # ninja by default creates cpu_count + 2 jobs, max RAM per job is thus
+    # RAM/num_jobs. Linking webengine requires several GB of RAM -- ka blammo
+    # Once it has been built the scheduler knows how much RAM it needs and
+    # limits parallelism to fit in the RAM budget
+    num = (build_parallelism() or 4) if for_webengine else (build_parallelism() or cpu_count() or 1)
+    used_parallelism(num)
+    if for_webengine and configure:
         ram = total_physical_ram()
-        num = 4
         print(f'Limiting parallelism to {num} workers with {ram/(1024**3)} GB of total physical RAM')
         for f in walk('.'):
             ext = f.rpartition('.')[2].lower()
             if ext in ('ninja', 'py', 'bat', 'json', 'sh', 'cc'):
                 replace_in_file(
                     f, 'ninja -C', f'ninja -j {num} -C', missing_ok=True)
-    run(*cmd, library_path=True, append_to_path=append_to_path, env=env)
-    run(CMAKE, '--install', '.', '--prefix', f'{build_dir()}/qt', env=env)
-    relocate_pkgconfig_files(prefix=PREFIX + '/qt')
+    if configure:
+        phase_completed()
+    if not should_skip_phase('build'):
+        run(*cmd, library_path=True, append_to_path=append_to_path, env=env)
+        phase_completed()
+    if not should_skip_phase('install'):
+        run(CMAKE, '--install', '.', '--prefix', f'{build_dir()}/qt', env=env)
+        relocate_pkgconfig_files(prefix=PREFIX + '/qt')
+        phase_completed()
     # if iswindows:
     #     if for_webengine:
     #         os.mkdir('process')
@@ -617,15 +775,19 @@ def python_build(extra_args=(), ignore_dependencies=False):
     extra_args = [f'--config-setting={x}' for x in extra_args]
     if ignore_dependencies:
         extra_args.append('--skip-dependency-check')
-    env = python_build_env()
-    run(PYTHON, '-m', 'build', '--wheel', '--no-isolation', *extra_args, library_path=True, env=env)
-    whl = glob.glob('dist/*.whl')[0]
-    os.symlink(whl, 'wheel')
+    if not should_skip_phase('build'):
+        env = python_build_env()
+        run(PYTHON, '-m', 'build', '--wheel', '--no-isolation', *extra_args, library_path=True, env=env)
+        whl = glob.glob('dist/*.whl')[0]
+        os.symlink(whl, 'wheel')
+        phase_completed()
     wheel_build()
 
 
 def wheel_build():
-    run(PYTHON, '-m', 'installer', '--no-compile-bytecode', '--prefix', build_dir(), os.path.realpath('wheel'), library_path=True)
+    if not should_skip_phase('install'):
+        run(PYTHON, '-m', 'installer', '--no-compile-bytecode', '--prefix', build_dir(), os.path.realpath('wheel'), library_path=True)
+        phase_completed()
 
 
 @lru_cache
@@ -682,6 +844,28 @@ def get_arches_in_binary(path):
     return {y for y in x.split()}
 
 
+def package_filter(module, exclude, exclude_extensions):
+    ''' Return a function that is True for the paths, relative to the build
+    dir and using / as the separator, that belong in the package '''
+    # A path is excluded if any of its components is in exclude or has an
+    # extension in exclude_extensions, test that with a single regex
+    names = '|'.join(re.escape(x) for x in sorted(exclude) if x and '/' not in x)
+    exts = '|'.join(re.escape(x) for x in sorted(exclude_extensions) if '.' not in x and '/' not in x)
+    alternatives = []
+    if names:
+        alternatives.append(f'(?:^|/)(?:{names})(?:/|$)')
+    if exts:
+        alternatives.append(f'\\.(?:{exts})(?:/|$)')
+    excluded = re.compile('|'.join(alternatives)).search if alternatives else lambda name: None
+    filter_pkg = getattr(module, 'filter_pkg', None)
+
+    def is_ok(name):
+        if excluded(name) is not None:
+            return False
+        return filter_pkg is None or not filter_pkg(name.split('/'))
+    return is_ok
+
+
 def create_package(module, outpath):
 
     exclude = getattr(module, 'pkg_exclude_names', set(
@@ -692,7 +876,10 @@ def create_package(module, outpath):
         'pyc', 'pyo', 'la', 'chm', 'cpp', 'rst', 'md')))
     if hasattr(module, 'modify_exclude_extensions'):
         module.modify_exclude_extensions(exclude_extensions)
+    is_ok = package_filter(module, exclude, exclude_extensions)
 
+    with suppress(FileNotFoundError):
+        os.remove(package_manifest_path(outpath))
     with suppress(FileNotFoundError):
         shutil.rmtree(outpath)
 
@@ -700,69 +887,187 @@ def create_package(module, outpath):
     check_universal_binaries = ismacos and len(
         UNIVERSAL_ARCHES) > 1 and not getattr(
             module, 'allow_non_universal', False)
-    dylibs = set()
+    is_ok_to_check_universal_arches = getattr(module, 'is_ok_to_check_universal_arches', lambda x: True)
     src_dir = build_dir()
+    # on Linux hardlinking fails because the package is built in tmpfs and
+    # outpath is on a different volume, so files are copied, using reflinks
+    # when the filesystems support them
+    copier = FileCopier()
+
+    def copy(src, name):
+        lcopy(src, os.path.join(outpath, name), no_hardlinks=islinux, copy_file=copier.copy_file)
+        if check_universal_binaries:
+            full_path = os.path.realpath(os.path.join(outpath, name))
+            if (name.endswith('.dylib') or is_macho_binary(full_path)) and is_ok_to_check_universal_arches(full_path):
+                return full_path
 
-    for dirpath, dirnames, filenames in os.walk(src_dir):
+    with ThreadPoolExecutor() as ex:
+        futures = []
+        for dirpath, dirnames, filenames in os.walk(src_dir):
+            rdir = os.path.relpath(dirpath, src_dir).replace(os.sep, '/')
+            prefix = '' if rdir == '.' else rdir + '/'
+            for d in tuple(dirnames):
+                if os.path.islink(os.path.join(dirpath, d)):
+                    dirnames.remove(d)
+                    filenames.append(d)
+                    continue
+                name = prefix + d
+                if is_ok(name):
+                    os.makedirs(os.path.join(outpath, name), exist_ok=True)
+                else:
+                    dirnames.remove(d)
+            for f in filenames:
+                name = prefix + f
+                if is_ok(name):
+                    futures.append(ex.submit(copy, os.path.join(dirpath, f), name))
+        dylibs = {x for x in (f.result() for f in futures) if x}
+
+        expected = set(UNIVERSAL_ARCHES)
+        for x, arches in zip(dylibs, ex.map(get_arches_in_binary, dylibs)):
+            if arches != expected:
+                print(
+                    f'The file {x} is not a universal binary.'
+                    f' Copied from {src_dir}.'
+                    f' It only has arches: {arches}', file=sys.stderr)
+                shutil.rmtree(outpath)
+                raise SystemExit('Failed to build universal binary')
+    write_package_manifest(outpath)
+
+
+# The manifest of a package lists every entry in it as:
+# [path, type, mode, size, symlink target, hash of contents]
+# with type being one of d, f or l. Paths use / as the separator.
+MANIFEST_VERSION = 1
+
+
+def package_manifest_path(pkg_path):
+    return pkg_path.rstrip(os.sep) + '.manifest'
+
+
+def hash_of_file(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
 
-        def get_name(x):
-            return os.path.relpath(os.path.join(dirpath, x),
-                                   src_dir).replace(os.sep, '/')
 
-        def is_ok(name):
-            parts = name.split('/')
-            for p in parts:
-                if p in exclude or (
-                    '.' in p and p.rpartition('.')[-1] in exclude_extensions
-                ):
-                    return False
-            if hasattr(module, 'filter_pkg') and module.filter_pkg(parts):
-                return False
-            return True
+def manifest_entry(path, name):
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        return [name, 'l', 0, 0, os.readlink(path), '']
+    if stat.S_ISDIR(st.st_mode):
+        return [name, 'd', stat.S_IMODE(st.st_mode), 0, '', '']
+    return [name, 'f', stat.S_IMODE(st.st_mode), st.st_size, '', hash_of_file(path)]
 
-        for d in tuple(dirnames):
-            if os.path.islink(os.path.join(dirpath, d)):
-                dirnames.remove(d)
-                filenames.append(d)
-                continue
-            name = get_name(d)
-            if is_ok(name):
-                try:
-                    os.makedirs(os.path.join(outpath, name))
-                except EnvironmentError as err:
-                    if err.errno != errno.EEXIST:
-                        raise
-            else:
-                dirnames.remove(d)
 
-        if hasattr(module, 'is_ok_to_check_universal_arches'):
-            is_ok_to_check_universal_arches = module.is_ok_to_check_universal_arches
-        else:
-            def always_ok(x):
-                return True
-            is_ok_to_check_universal_arches = always_ok
-        for f in filenames:
-            name = get_name(f)
-            if is_ok(name):
-                # on Linux hardlinking fails because the package is
-                # built in tmpfs and outpath is on a different volume
-                lcopy(os.path.join(dirpath, f), os.path.join(outpath, name),
-                      no_hardlinks=islinux)
-                full_path = os.path.realpath(os.path.join(outpath, name))
-                if check_universal_binaries and full_path not in dylibs and (
-                        name.endswith('.dylib') or is_macho_binary(
-                            full_path)) and is_ok_to_check_universal_arches(full_path):
-                    dylibs.add(full_path)
-    expected = set(UNIVERSAL_ARCHES)
-    for x in dylibs:
-        arches = get_arches_in_binary(x)
-        if arches != expected:
-            print(
-                f'The file {x} is not a universal binary.'
-                f' Copied from {src_dir}.'
-                f' It only has arches: {arches}', file=sys.stderr)
-            shutil.rmtree(outpath)
-            raise SystemExit('Failed to build universal binary')
+def write_package_manifest(pkg_path):
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(pkg_path):
+        for x in tuple(dirnames):
+            if os.path.islink(os.path.join(dirpath, x)):
+                dirnames.remove(x)
+                filenames.append(x)
+        for x in dirnames + filenames:
+            path = os.path.join(dirpath, x)
+            paths.append((path, os.path.relpath(path, pkg_path).replace(os.sep, '/')))
+    # hashlib releases the GIL, so files are hashed in parallel
+    with ThreadPoolExecutor() as ex:
+        entries = list(ex.map(lambda x: manifest_entry(*x), paths))
+    atomic_write(package_manifest_path(pkg_path), json.dumps(
+        {'version': MANIFEST_VERSION, 'hash': 'blake2b-128', 'entries': entries}, separators=(',', ':')))
+
+
+def read_package_manifest(pkg_path):
+    ' The entries in the manifest of the package or None if it has no usable manifest '
+    try:
+        with open(package_manifest_path(pkg_path), 'rb') as f:
+            data = json.loads(f.read())
+    except (FileNotFoundError, ValueError):
+        return None
+    if data.get('version') != MANIFEST_VERSION:
+        return None
+    if os.sep != '/':
+        for e in data['entries']:
+            e[0] = e[0].replace('/', os.sep)
+    return data['entries']
+
+
+def verify_package(pkg_path):
+    ' Return a list of the differences between a package and its manifest '
+    manifest = read_package_manifest(pkg_path)
+    if manifest is None:
+        return ['has no manifest']
+    problems = []
+    for e in manifest:
+        path = os.path.join(pkg_path, e[0])
+        try:
+            actual = manifest_entry(path, e[0])
+        except OSError:
+            problems.append(f'{e[0]} is missing')
+            continue
+        if actual[1:] != e[1:]:
+            fields = ('type', 'mode', 'size', 'symlink target', 'hash')
+            changed = (f for f, a, b in zip(fields, actual[1:], e[1:]) if a != b)
+            problems.append(f'{e[0]} has a different {", ".join(changed)}')
+    known = {e[0] for e in manifest}
+    for dirpath, dirnames, filenames in os.walk(pkg_path):
+        for x in dirnames + filenames:
+            name = os.path.relpath(os.path.join(dirpath, x), pkg_path)
+            if name not in known:
+                problems.append(f'{name} is not in the manifest')
+    return problems
+
+
+def link_duplicate(src, dest):
+    ''' Replace dest with a hard link to src, keeping the modification time of
+    the directory containing it, which identifies top level packages '''
+    parent = os.path.dirname(dest)
+    st = os.stat(parent)
+    tmp = dest + '.bypy-dedup'
+    os.link(src, tmp)
+    try:
+        os.replace(tmp, dest)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    os.utime(parent, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def dedup_packages(pkg_paths):
+    ''' Hard link the identical regular files in the specified packages to
+    each other, finding them via the content hashes in the package manifests.
+    Returns the number of bytes saved. '''
+    groups = {}
+    for pkg_path in pkg_paths:
+        for name, ftype, mode, size, _, h in read_package_manifest(pkg_path) or ():
+            # Linking empty files saves nothing
+            if ftype == 'f' and size > 0:
+                groups.setdefault((h, size, mode), []).append(os.path.join(pkg_path, name))
+    saved = 0
+    for paths in groups.values():
+        if len(paths) < 2:
+            continue
+        src, sst = paths[0], os.stat(paths[0])
+        for dest in paths[1:]:
+            st = os.stat(dest)
+            if st.st_ino == sst.st_ino and st.st_dev == sst.st_dev:
+                continue  # already linked by a previous run
+            # The manifest could be out of date if a package was modified after
+            # it was created, so never link files whose contents differ
+            if st.st_dev != sst.st_dev or not filecmp.cmp(src, dest, shallow=False):
+                continue
+            try:
+                link_duplicate(src, dest)
+            except OSError as err:
+                if err.errno != errno.EMLINK:
+                    raise
+                # src has the maximum number of links, use dest for the rest
+                src, sst = dest, st
+                continue
+            if st.st_nlink == 1:
+                saved += st.st_size
+    return saved
 
 
 @contextmanager
@@ -836,10 +1141,14 @@ def install_binaries(
 
 
 def replace_in_file(path, old, new, missing_ok=False):
+    # Edits are phases so that resuming a build does not apply them twice
+    if should_skip_phase(f'edit {path}'):
+        return True
     if isinstance(old, str):
         old = old.encode('utf-8')
     if isinstance(new, str):
         new = new.encode('utf-8')
+    break_hardlink(path)
     with open(path, 'r+b') as f:
         raw = f.read()
         if not old:
@@ -860,7 +1169,8 @@ def replace_in_file(path, old, new, missing_ok=False):
                 f'Failed (pattern "{pat_repr}" not found) to patch: {path}')
         f.seek(0), f.truncate()
         f.write(nraw)
-        return replaced
+    phase_completed()
+    return replaced
 
 
 @contextmanager
@@ -1008,16 +1318,22 @@ def cmake_build(
     cmd.append('..')
     env = env or {}
     env['CMAKE_PREFIX_PATH'] = PREFIX
-    run(*cmd, cwd='build', append_to_path=append_to_path, env=env)
-    make_opts = []
-    if not iswindows:
-        make_opts = [] if no_parallel else split(MAKEOPTS)
-    run(make, *(make_opts + list(make_args)),
-        cwd='build', env=env, append_to_path=append_to_path)
-    mi = [make] + list(install_args) + ['install']
-    run(*mi, library_path=library_path, cwd='build')
-    if relocate_pkgconfig:
-        relocate_pkgconfig_files()
+    if not should_skip_phase('configure'):
+        run(*cmd, cwd='build', append_to_path=append_to_path, env=env)
+        phase_completed()
+    if not should_skip_phase('build'):
+        make_opts = []
+        if not iswindows:
+            make_opts = [] if no_parallel else split(makeopts())
+        run(make, *(make_opts + list(make_args)),
+            cwd='build', env=env, append_to_path=append_to_path)
+        phase_completed()
+    if not should_skip_phase('install'):
+        mi = [make] + list(install_args) + ['install']
+        run(*mi, library_path=library_path, cwd='build')
+        if relocate_pkgconfig:
+            relocate_pkgconfig_files()
+        phase_completed()
 
 
 def meson_build(extra_cmdline='', library_path=None, **options):
@@ -1057,10 +1373,18 @@ cpp_link_args = ['-arch', '{current_build_arch()}']
         cmd += shlex.split(extra_cmdline)
     cmd += [f'-D{k}={v}' for k, v in options.items()]
     cmd.append('build')
-    run(*cmd, append_to_path=append_to_path)
-    run(NINJA, '-v', '-C', 'build', library_path=library_path, append_to_path=append_to_path)
-    run(NINJA, '-C', 'build', 'install', library_path=library_path, append_to_path=append_to_path)
-    relocate_pkgconfig_files()
+    if not should_skip_phase('configure'):
+        run(*cmd, append_to_path=append_to_path)
+        phase_completed()
+    if not should_skip_phase('build'):
+        jobs = ['-j', str(build_parallelism())] if build_parallelism() else []
+        used_parallelism(build_parallelism() or cpu_count() or 1)
+        run(NINJA, '-v', *jobs, '-C', 'build', library_path=library_path, append_to_path=append_to_path)
+        phase_completed()
+    if not should_skip_phase('install'):
+        run(NINJA, '-C', 'build', 'install', library_path=library_path, append_to_path=append_to_path)
+        relocate_pkgconfig_files()
+        phase_completed()
 
 
 class ModifiedEnv:
@@ -1086,6 +1410,8 @@ class ModifiedEnv:
 def apply_patch(name, level=0, reverse=False, convert_line_endings=False):
     if not os.path.isabs(name):
         name = os.path.join(PATCHES, name)
+    if should_skip_phase(f'patch {os.path.basename(name)}'):
+        return
     patch = 'C:/cygwin64/bin/patch' if iswindows else 'patch'
     args = [patch, '-p%d' % level, '-i', name]
     if reverse:
@@ -1094,6 +1420,7 @@ def apply_patch(name, level=0, reverse=False, convert_line_endings=False):
         run('C:/cygwin64/bin/unix2dos', name)
         args.insert(1, '--binary')
     run(*args)
+    phase_completed()
 
 
 def apply_patches(prefix, level=1, reverse=False, convert_line_endings=False):
@@ -1142,8 +1469,14 @@ def create_job(cmd, human_text=None):
 
 
 def parallel_build(jobs, log=print, verbose=True):
-    with ThreadPoolExecutor() as ex:
-        for ok, stdout, stderr in ex.map(run_worker, jobs):
+    used_parallelism(build_parallelism() or cpu_count() or 1)
+    with JobServerClient() as jobserver, ThreadPoolExecutor(max_workers=build_parallelism() or None) as ex:
+
+        def worker(job):
+            with jobserver.slot():
+                return run_worker(job)
+
+        for ok, stdout, stderr in ex.map(worker, jobs):
             if verbose or not ok:
                 log(stdout)
                 if stderr:
@@ -1269,6 +1602,10 @@ def setup_program_parser(pa):
       default=False,
       action='store_true',
       help='Do not run a shell if building fails')
+    a('--overlay-prefix',
+      default=False,
+      action='store_true',
+      help='In the Linux container, mount the packages as an overlay instead of installing their files, needs Linux >= 5.11')
     a('--build-only',
       help='Build only a single extension module when building'
       ' program, useful for development')
@@ -1279,7 +1616,7 @@ def setup_program_parser(pa):
 def cmdline_for_program(args):
     ans = ['program', '--compression-level', args.compression_level]
     for x in (
-        'dont_strip', 'skip_tests', 'sign_installers', 'notarize', 'non_interactive',
+        'dont_strip', 'skip_tests', 'sign_installers', 'notarize', 'non_interactive', 'overlay_prefix',
     ):
         if getattr(args, x):
             ans.append('--' + x.replace('_', '-'))
@@ -1303,10 +1640,69 @@ def setup_dependencies_parser(p):
         ' only are built. Available deps:' +
         ' '.join(choices)
     )
+    p.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help='The number of dependencies to build concurrently. Dependencies are built concurrently only'
+        ' if their inputs are declared via a depends key in sources.json or a depends attribute in their'
+        ' recipe module, dependencies without a declaration depend on all dependencies before them.'
+    )
+    p.add_argument(
+        '--plan', action='store_true',
+        help='Print the order in which the dependencies would be built along with their estimated build times'
+        ' based on previous builds and exit, without building anything.'
+    )
+    p.add_argument(
+        '--overlay-prefix', action='store_true',
+        help='In the Linux container, mount the packages as an overlay instead of installing their files, needs Linux >= 5.11.'
+    )
+    p.add_argument(
+        '--checkpoint', action='store_true',
+        help='Keep the build tree of a dependency whose build fails and record the phases of the build that completed,'
+        ' so that the build can be continued with --resume.'
+    )
+    p.add_argument(
+        '--resume', metavar='NAME', default='',
+        help='Continue the failed build of the specified dependency from the phase that failed.'
+        ' The failed build must have been run with --checkpoint. Completed phases, including edits of'
+        ' the source with replace_in_file(), are skipped and their results in the kept build tree are'
+        ' used as is. Recipe code that is not part of a phase is run again, recipes must use run_phase()'
+        ' for steps that cannot be repeated, such as moving installed files.'
+    )
+    p.add_argument(
+        '--dedup', action='store_true',
+        help='Replace identical files in the previously built packages with hard links to a single copy and exit.'
+        ' This is also done after every successful build.'
+    )
+    p.add_argument(
+        '--verify', action='store_true',
+        help='Check that the previously built packages are unchanged since they were created, using their manifests, and exit.'
+    )
+    p.add_argument(
+        '--ram-budget', type=float, default=0,
+        help='The amount of RAM in GB that concurrent builds are allowed to use. Defaults to 85%% of physical RAM.'
+        ' Builds are started, and their parallelism limited, based on the peak RAM used by previous builds.'
+    )
 
 
 def cmdline_for_dependencies(args):
-    return ['dependencies'] + args.dependencies
+    ans = ['dependencies']
+    if args.jobs != 1:
+        ans += ['--jobs', str(args.jobs)]
+    if args.plan:
+        ans.append('--plan')
+    if args.ram_budget:
+        ans += ['--ram-budget', str(args.ram_budget)]
+    if args.checkpoint:
+        ans.append('--checkpoint')
+    if args.resume:
+        ans += ['--resume', args.resume]
+    if args.dedup:
+        ans.append('--dedup')
+    if args.verify:
+        ans.append('--verify')
+    if args.overlay_prefix:
+        ans.append('--overlay-prefix')
+    return ans + args.dependencies
 
 
 def setup_build_parser(p):
@@ -1362,6 +1758,14 @@ def total_physical_ram():
     return GlobalMemoryStatusEx().ullTotalPhys
 
 
+def available_physical_ram():
+    ' The RAM that can be used without swapping, None if unknown '
+    if islinux:
+        with open('/proc/meminfo') as f:
+            raw = f.read()
+        return int(re.search(r'^MemAvailable:\s+(\d+)', raw, flags=re.M).group(1)) * 1024
+
+
 def require_ram(gb=4):
     if total_physical_ram() < (gb * 1024**3):
         raise SystemExit(f'Need at least {gb}GB of RAM to build')
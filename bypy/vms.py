@@ -14,8 +14,12 @@ from virtual_machine.run import BUILD_VM_USER, forwarded_port, server_from_spec,
 
 from .conf import parse_conf_file
 from .constants import base_dir
+from .download_sources import SOURCE_STORE_NAME, VERIFIED_INDEX_NAME
 from .utils import cmdline_for_dependencies, cmdline_for_program
 
+# Files in the sources dir that are not mirrored between machines
+SOURCES_LOCAL_FILES = frozenset({'/' + SOURCE_STORE_NAME, '/' + VERIFIED_INDEX_NAME})
+
 
 def get_rsync_conf():
     ans = getattr(get_rsync_conf, 'ans', None)
@@ -100,41 +104,57 @@ exec "$SHELL" -il
                 from_vm(self, sources_dir, pkg_dir, output_dir, prefix=prefix, name=name)
             raise SystemExit(cp.returncode)
 
+    def start_source_mirror(self, sources_dir):
+        # Serve the sources cache to the VM so that it fetches only the
+        # sources it needs, instead of copying the whole cache into it
+        from .mirror import run_server
+        httpd = run_server(sources_dir)
+        remote_port = self.setup_port_forwarding(httpd.server_address[1])
+        return f'BYPY_MIRROR=http://localhost:{remote_port}'
+
     def main(self, sources_dir, pkg_dir, output_dir, cmd_prefix, args, prefix='/', name='sw', get_from_vm=True, callback_after_get=lambda : None):
+        sync_sources = self.is_chroot_based
+        if not sync_sources:
+            cmd_prefix = list(cmd_prefix) + [self.start_source_mirror(sources_dir)]
         ws_cmd = list(cmd_prefix) + ['worker-status']
-        to_vm(self, ws_cmd, sources_dir, pkg_dir, prefix=prefix, name=name)
+        to_vm(self, ws_cmd, sources_dir, pkg_dir, prefix=prefix, name=name, sync_sources=sync_sources)
         cp = self.run_via_ssh(*cmd_prefix, *remote_cmd(args), allocate_tty=True, raise_exception=False)
         if get_from_vm:
             from_vm(self, sources_dir, pkg_dir, output_dir, prefix=prefix, name=name)
             callback_after_get()
         raise SystemExit(cp.returncode)
 
-    def from_vm(self, from_, to, excludes=frozenset()):
+    def from_vm(self, from_, to, excludes=frozenset(), delete=True):
         if self.is_chroot_based:
             f = os.path.join(self.chroot_path, from_.lstrip('/'))
             if os.path.islink(f):
                 f = os.path.join(self.chroot_path, os.readlink(f).lstrip('/'))
         else:
             f = BUILD_VM_USER + '@' + self.server + ':' + from_
-        return self.rsync_command(f, to, excludes)
+        return self.rsync_command(f, to, excludes, delete)
 
-    def to_vm(self, from_, to, excludes=frozenset()):
+    def to_vm(self, from_, to, excludes=frozenset(), protect=frozenset()):
         if self.is_chroot_based:
             t = os.path.join(self.chroot_path, to.lstrip('/'))
             if os.path.islink(t):
                 t = os.path.join(self.chroot_path, os.readlink(t).lstrip('/'))
         else:
             t = BUILD_VM_USER + '@' + self.server + ':' + to
-        return self.rsync_command(from_, t, excludes)
+        return self.rsync_command(from_, t, excludes, protect=protect)
 
-    def rsync_command(self, from_, to, excludes=frozenset()):
+    def rsync_command(self, from_, to, excludes=frozenset(), delete=True, protect=frozenset()):
         if isinstance(excludes, type('')):
             excludes = excludes.split()
         excludes = frozenset(excludes) | self.excludes
         excludes = ['--exclude=' + x for x in excludes]
-        cmd = [
-            'rsync', '--info=stats', '-a', '-zz', '--delete', '--delete-excluded', '--chmod', 'og-w',
-        ]
+        # protected files are not deleted from the destination even though
+        # --delete-excluded is used
+        excludes += ['--filter=P ' + x for x in sorted(protect)]
+        # -H so that the files in packages that are hard linked to each other stay so
+        cmd = ['rsync', '--info=stats', '-a', '-H', '-zz']
+        if delete:
+            cmd += ['--delete', '--delete-excluded']
+        cmd += ['--chmod', 'og-w']
         if not self.is_chroot_based:
             ssh = shlex.join(ssh_command_to(server=self.server, port=self.port)[:-1])
             cmd += ['-e', ssh]
@@ -191,6 +211,12 @@ def run_sync_jobs(cmds, retry=False):
     sys.stdout.buffer.write(workers[-1].stdout.strip())
     print(flush=True)
 
+def compiler_cache_dir(pkg_dir):
+    ans = os.path.join(os.path.dirname(pkg_dir), 'ccache')
+    os.makedirs(ans, exist_ok=True)
+    return ans
+
+
 def src_to_vm_cmd(rsync, dirs_to_ensure, to_vm_calls, prefix='/'):
     src_dir = os.path.dirname(base_dir())
     if os.path.exists(os.path.join(src_dir, 'setup.py')):
@@ -201,7 +227,7 @@ def src_to_vm_cmd(rsync, dirs_to_ensure, to_vm_calls, prefix='/'):
         to_vm_calls.append(rsync.to_vm(src_dir, to, excludes))
 
 
-def to_vm(rsync, initial_cmd, sources_dir, pkg_dir, prefix='/', name='sw'):
+def to_vm(rsync, initial_cmd, sources_dir, pkg_dir, prefix='/', name='sw', sync_sources=True):
     start = time.monotonic()
     print('Mirroring data to the VM...', flush=True)
     prefix = prefix.rstrip('/') + '/'
@@ -209,14 +235,20 @@ def to_vm(rsync, initial_cmd, sources_dir, pkg_dir, prefix='/', name='sw'):
     to_vm_calls = []
     src_to_vm_cmd(rsync, dirs_to_ensure, to_vm_calls, prefix)
 
-    def a(src, to, excludes=frozenset()):
+    def a(src, to, excludes=frozenset(), protect=frozenset()):
         dirs_to_ensure.append(to)
-        to_vm_calls.append(rsync.to_vm(src, to, excludes))
+        to_vm_calls.append(rsync.to_vm(src, to, excludes, protect))
 
     base = os.path.dirname(os.path.abspath(__file__))
     a(os.path.dirname(base), prefix + 'bypy')
-    a(sources_dir, prefix + 'sources')
+    if sync_sources:
+        # The index of verified files and the store of downloads are local
+        # to each machine, the inodes in the index do not match elsewhere
+        a(sources_dir, prefix + 'sources', SOURCES_LOCAL_FILES, SOURCES_LOCAL_FILES)
+    else:
+        dirs_to_ensure.append(prefix + 'sources')
     a(pkg_dir, prefix + name + '/pkg')
+    a(compiler_cache_dir(pkg_dir), prefix + name + '/ccache')
     if 'PENV' in os.environ:
         code_signing = os.path.expanduser(os.path.join(
             os.environ['PENV'], 'code-signing'))
@@ -245,7 +277,10 @@ def from_vm(rsync, sources_dir, pkg_dir, output_dir, prefix='/', name='sw'):
     cmds = []
     a = cmds.append
     a(rsync.from_vm(prefix + name + '/dist', output_dir))
-    a(rsync.from_vm(prefix + 'sources', sources_dir))
+    # The VM may have only some of the sources, so dont delete the rest
+    # The store and the verified files index are specific to the VM filesystem
+    a(rsync.from_vm(prefix + 'sources', sources_dir, excludes=SOURCES_LOCAL_FILES, delete=False))
     a(rsync.from_vm(prefix + name + '/pkg', pkg_dir))
+    a(rsync.from_vm(prefix + name + '/ccache', compiler_cache_dir(pkg_dir)))
     run_sync_jobs(cmds, retry=True)
     print(f'Mirroring took {time.monotonic() - start:.1f} seconds', flush=True)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import os
+import tempfile
+import unittest
+
+from bypy.checkpoint import Checkpoint, current_checkpoint, phase_completed, run_phase, should_skip_phase
+from bypy.utils import replace_in_file
+
+
+class TestResume(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+        self.addCleanup(current_checkpoint, None)
+        self.state = os.path.join(self.tdir.name, 'checkpoint')
+        self.src = os.path.join(self.tdir.name, 'src')
+        self.output = os.path.join(self.tdir.name, 'output')
+        self.ran: list[str] = []
+
+    def recipe(self, fail_in=''):
+        ' A recipe that edits its source, installs and then moves the installed files '
+        def phase(name, func):
+            if not should_skip_phase(name):
+                self.ran.append(name)
+                if fail_in == name:
+                    raise SystemExit(1)
+                func()
+                phase_completed()
+
+        def extract():
+            os.mkdir(self.src)
+            with open(os.path.join(self.src, 'Makefile'), 'w') as f:
+                f.write('PREFIX=/usr\n')
+
+        def install():
+            os.makedirs(os.path.join(self.output, 'usr', 'lib'))
+
+        def move_installed_files():
+            self.ran.append('move installed files')
+            if fail_in == 'move installed files':
+                raise SystemExit(1)
+            os.rename(os.path.join(self.output, 'usr', 'lib'), os.path.join(self.output, 'lib'))
+            os.rmdir(os.path.join(self.output, 'usr'))
+
+        phase('extract', extract)
+        replace_in_file(os.path.join(self.src, 'Makefile'), '/usr', '/sw')
+        phase('configure', lambda: None)
+        phase('build', lambda: None)
+        phase('install', install)
+        run_phase('move installed files', move_installed_files)
+        phase('package', lambda: None)
+
+    def run_recipe(self, resume=False, fail_in=''):
+        current_checkpoint(Checkpoint(self.state, resume=resume))
+        self.ran = []
+        try:
+            self.recipe(fail_in)
+        finally:
+            current_checkpoint(None)
+
+    def test_resume_after_post_install_step(self):
+        with self.assertRaises(SystemExit):
+            self.run_recipe(fail_in='package')
+        self.run_recipe(resume=True)
+        self.assertEqual(self.ran, ['package'])
+        self.assertEqual(os.listdir(self.output), ['lib'])
+        with open(os.path.join(self.src, 'Makefile')) as f:
+            self.assertEqual(f.read(), 'PREFIX=/sw\n')
+
+    def test_resume_in_post_install_step(self):
+        with self.assertRaises(SystemExit):
+            self.run_recipe(fail_in='move installed files')
+        self.run_recipe(resume=True)
+        self.assertEqual(self.ran, ['move installed files', 'package'])
+        self.assertEqual(os.listdir(self.output), ['lib'])
+
+    def test_resume_before_configure(self):
+        # Nothing after preparing the source completed, so the build is
+        # restarted from scratch
+        with self.assertRaises(SystemExit):
+            self.run_recipe(fail_in='configure')
+        os.rename(self.src, self.src + '-failed')
+        self.run_recipe(resume=True)
+        self.assertEqual(self.ran, ['extract', 'configure', 'build', 'install', 'move installed files', 'package'])
+        with open(os.path.join(self.src, 'Makefile')) as f:
+            self.assertEqual(f.read(), 'PREFIX=/sw\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
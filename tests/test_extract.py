@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import io
+import lzma
+import os
+import tarfile
+import tempfile
+import unittest
+
+from bypy.utils import extract, parallel_decompressor
+
+
+def make_archive(path, files, blocking_factor=20):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w', format=tarfile.GNU_FORMAT) as tf:
+        for name, data in files.items():
+            ti = tarfile.TarInfo(name)
+            ti.size = len(data)
+            tf.addfile(ti, io.BytesIO(data))
+    # Pad to a whole number of records, like tar -b does
+    record_size = blocking_factor * tarfile.BLOCKSIZE
+    raw = buf.getvalue()
+    raw += b'\0' * (-len(raw) % record_size)
+    with open(path, 'wb') as f:
+        f.write(lzma.compress(raw))
+
+
+class TestExtract(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+        self.source = os.path.join(self.tdir.name, 'src.tar.xz')
+        self.dest = os.path.join(self.tdir.name, 'dest')
+        os.mkdir(self.dest)
+
+    @unittest.skipUnless(parallel_decompressor('x.tar.xz'), 'no parallel decompressor for xz')
+    def test_large_blocking_factor(self):
+        # The padding after the end of archive marker is larger than the pipe
+        # buffer, so the decompressor is still writing it when tarfile stops
+        make_archive(self.source, {'src/a': b'a'}, blocking_factor=2048)
+        for i in range(5):
+            with self.subTest(i=i):
+                dest = os.path.join(self.dest, str(i))
+                os.mkdir(dest)
+                extract(self.source, dest)
+                with open(os.path.join(dest, 'src', 'a'), 'rb') as f:
+                    self.assertEqual(f.read(), b'a')
+
+
+if __name__ == '__main__':
+    unittest.main()